@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk changes to currency_users, and moving it in and out of CSV or JSONL files.
+
+    python -m admin export users.csv [coins>=100 ...]
+    python -m admin import users.jsonl [--add]
+    python -m admin reset coins<10 last_picked<2020-01-01
+    python -m admin adjust -- -5 122122926760656896 69198249432449024
+
+Accounts are picked by user id and/or filters on ``coins``, ``last_picked`` and ``user_id``
+(``<``, ``<=``, ``=``, ``>=``, ``>``). Everything given has to match. Every change is logged
+to coin_events, so balances can still be rebuilt from the log afterwards.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import re
+
+import toml
+
+import database
+from coordination import NOTIFY_CHANNEL
+
+
+FILTER = re.compile(r"^(coins|last_picked|user_id)(<=|>=|<|>|=)(.+)$")
+
+FIELDS = {
+    "coins": int,
+    "user_id": int,
+    "last_picked": datetime.datetime.fromisoformat,
+}
+
+COLUMNS = ("user_id", "coins", "last_picked")
+
+FORMATS = ("csv", "jsonl")
+
+COUNT_USERS = "SELECT COUNT(*), COALESCE(SUM(coins), 0) FROM currency_users WHERE {where}"
+
+RESET_USERS = """
+WITH removed AS (DELETE FROM currency_users WHERE {where} RETURNING user_id, coins),
+logged AS (
+    INSERT INTO coin_events (event_time, user_id, amount, kind)
+    SELECT NOW() AT TIME ZONE 'UTC', user_id, -coins, 'reset' FROM removed
+)
+SELECT COUNT(*), COALESCE(SUM(-coins), 0) FROM removed
+"""
+
+# the targets are locked before they're read, so grants landing meanwhile are counted in the logged amount
+ADJUST_USERS = """
+WITH targets AS (SELECT user_id, coins FROM currency_users WHERE {where} FOR UPDATE),
+adjusted AS (
+    UPDATE currency_users SET coins = GREATEST(targets.coins + $1, 0) FROM targets
+    WHERE currency_users.user_id = targets.user_id
+    RETURNING currency_users.user_id, currency_users.coins - targets.coins AS amount
+),
+logged AS (
+    INSERT INTO coin_events (event_time, user_id, amount, kind)
+    SELECT NOW() AT TIME ZONE 'UTC', user_id, amount, 'adjust' FROM adjusted WHERE amount <> 0
+)
+SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM adjusted
+"""
+
+EXPORT_USERS = "SELECT user_id, coins, last_picked FROM currency_users WHERE {where} ORDER BY user_id"
+
+CREATE_IMPORT = """
+CREATE TEMPORARY TABLE import_users (user_id BIGINT NOT NULL, coins INT NOT NULL, last_picked TIMESTAMP)
+ON COMMIT DROP
+"""
+
+# rows for the same user are added together; {coins} is the new balance, before clamping at 0
+MERGE_IMPORT = """
+WITH incoming AS (
+    SELECT user_id, SUM(coins) AS coins, MAX(last_picked) AS last_picked FROM import_users GROUP BY user_id
+),
+merged AS (
+    SELECT incoming.user_id, COALESCE(account.coins, 0) AS old_coins, GREATEST({coins}, 0) AS coins,
+           incoming.last_picked
+    FROM incoming LEFT JOIN currency_users account USING (user_id)
+),
+logged AS (
+    INSERT INTO coin_events (event_time, user_id, amount, kind)
+    SELECT NOW() AT TIME ZONE 'UTC', user_id, coins - old_coins, 'import' FROM merged WHERE coins <> old_coins
+),
+written AS (
+    INSERT INTO currency_users (user_id, coins, last_picked)
+    SELECT user_id, coins, last_picked FROM merged
+    ON CONFLICT (user_id) DO UPDATE
+    SET coins = EXCLUDED.coins, last_picked = GREATEST(EXCLUDED.last_picked, currency_users.last_picked)
+)
+SELECT COUNT(*), COALESCE(SUM(coins - old_coins), 0) FROM merged
+"""
+
+IMPORT_COINS = {
+    "set": "incoming.coins",
+    "add": "COALESCE(account.coins, 0) + incoming.coins",
+}
+
+
+class Selection:
+    """Which accounts a bulk operation applies to: listed user ids, narrowed down by filters."""
+
+    def __init__(self, user_ids=(), filters=()):
+        self.user_ids = list(user_ids)
+        self.filters = list(filters)  # (column, operator, value)
+
+    def __bool__(self):
+        return bool(self.user_ids or self.filters)
+
+    def __str__(self):
+        terms = [f"{column}{operator}{value}" for column, operator, value in self.filters]
+        if self.user_ids:
+            terms.insert(0, f"{len(self.user_ids)} listed user(s)")
+        return ", ".join(terms) or "everyone"
+
+    @classmethod
+    def parse(cls, terms) -> "Selection":
+        """Builds a selection from user ids, mentions and filters like ``coins>=100``. Raises ValueError."""
+        user_ids = []
+        filters = []
+
+        for term in terms:
+            term = term.strip("<@!>") if term.startswith("<@") else term
+
+            if term.isdigit():
+                user_ids.append(int(term))
+                continue
+
+            match = FILTER.match(term)
+            if match is None:
+                raise ValueError(f"{term!r} isn't a user id or a filter like coins>=100")
+
+            column, operator, value = match.groups()
+            try:
+                filters.append((column, operator, FIELDS[column](value)))
+            except ValueError:
+                raise ValueError(f"{value!r} isn't a valid value for {column}") from None
+
+        return cls(user_ids, filters)
+
+    def where(self, first_argument: int = 1):
+        """Returns the SQL condition and its arguments, numbered from ``first_argument``."""
+        conditions = []
+        arguments = []
+
+        if self.user_ids:
+            arguments.append(self.user_ids)
+            conditions.append(f"user_id = ANY(${first_argument}::BIGINT[])")
+
+        for column, operator, value in self.filters:
+            arguments.append(value)
+            conditions.append(f"{column} {operator} ${first_argument + len(arguments) - 1}")
+
+        return " AND ".join(conditions) or "TRUE", arguments
+
+
+def export_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Can't tell the format of {path}, it should end in .csv or .jsonl")
+    return extension
+
+
+def to_json(record) -> str:
+    last_picked = record["last_picked"]
+    return json.dumps({"user_id": record["user_id"], "coins": record["coins"],
+                       "last_picked": last_picked.isoformat() if last_picked is not None else None})
+
+
+def read_jsonl(fp, size: int):
+    """Yields lists of up to ``size`` (user_id, coins, last_picked) tuples from a JSONL file."""
+    chunk = []
+
+    for number, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+            last_picked = row.get("last_picked")
+            chunk.append((int(row["user_id"]), int(row["coins"]),
+                          datetime.datetime.fromisoformat(last_picked) if last_picked else None))
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            raise ValueError(f"Line {number} isn't a valid account: {error}") from None
+
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+async def count_users(conn, selection: Selection):
+    """Returns how many accounts ``selection`` matches and how many coins they have between them."""
+    where, arguments = selection.where()
+    return tuple(await conn.fetchrow(COUNT_USERS.format(where=where), *arguments))
+
+
+async def reset_users(conn, selection: Selection):
+    """Deletes the matching accounts. Returns how many there were and the change in coins."""
+    where, arguments = selection.where()
+    return tuple(await conn.fetchrow(RESET_USERS.format(where=where), *arguments))
+
+
+async def adjust_users(conn, selection: Selection, amount: int):
+    """Adds ``amount`` (which can be negative, stopping at 0) to the matching accounts.
+
+    Returns how many accounts were changed and the change in coins.
+    """
+    where, arguments = selection.where(2)
+    return tuple(await conn.fetchrow(ADJUST_USERS.format(where=where), amount, *arguments))
+
+
+async def export_users(conn, path: str, selection: Selection = None, chunk_size: int = 1000) -> int:
+    """Writes the matching accounts to ``path`` (.csv or .jsonl) in user id order. Returns how many were written.
+
+    CSV goes straight through ``COPY``; JSONL is read with a server-side cursor, ``chunk_size``
+    rows at a time. Either way only a chunk is held in memory, and writes happen off the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    where, arguments = (selection or Selection()).where()
+    query = EXPORT_USERS.format(where=where)
+
+    if export_format(path) == "csv":
+        status = await conn.copy_from_query(query, *arguments, output=path, format="csv", header=True)
+        return int(status.split()[-1])
+
+    written = 0
+    with open(path, "w", encoding="utf-8") as fp:
+        async with conn.transaction():
+            cursor = await conn.cursor(query, *arguments)
+
+            while True:
+                records = await cursor.fetch(chunk_size)
+                if not records:
+                    return written
+
+                await loop.run_in_executor(None, fp.write, "".join(f"{to_json(record)}\n" for record in records))
+                written += len(records)
+
+
+async def import_users(conn, path: str, mode: str = "set", chunk_size: int = 1000):
+    """Loads accounts from ``path`` (.csv or .jsonl, as written by :func:`export_users`).
+
+    With ``mode`` "set" imported balances replace existing ones, with "add" they're added on.
+    Rows are copied into a temporary table with ``COPY`` (CSV as it's read, JSONL ``chunk_size``
+    lines at a time) and merged in one transaction, so a bad file changes nothing.
+
+    Returns how many accounts were imported and the change in coins.
+    """
+    loop = asyncio.get_event_loop()
+    file_format = export_format(path)
+
+    async with conn.transaction():
+        # grants wait for this rather than landing between the balances being read and written
+        await conn.execute("LOCK TABLE currency_users IN EXCLUSIVE MODE")
+        await conn.execute(CREATE_IMPORT)
+
+        if file_format == "csv":
+            await conn.copy_to_table("import_users", source=path, columns=COLUMNS, format="csv", header=True)
+        else:
+            with open(path, "r", encoding="utf-8") as fp:
+                chunks = read_jsonl(fp, chunk_size)
+
+                while True:
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        break
+
+                    await conn.copy_records_to_table("import_users", records=chunk, columns=COLUMNS)
+
+        return tuple(await conn.fetchrow(MERGE_IMPORT.format(coins=IMPORT_COINS[mode])))
+
+
+async def main(args):
+    with open(args.config, "r", encoding="utf-8") as fp:
+        credentials = toml.load(fp)["database"]
+
+    pool = await database.create_pool({**credentials, "min_size": 1, "max_size": 1})
+
+    try:
+        async with pool.acquire() as conn:
+            if args.command == "export":
+                written = await export_users(conn, args.path, Selection.parse(args.targets))
+                print(f"Exported {written} account(s) to {args.path}.")
+                return
+
+            if args.command == "import":
+                accounts, coins = await import_users(conn, args.path, "add" if args.add else "set")
+            else:
+                selection = Selection.parse(args.targets)
+                if not selection:
+                    raise SystemExit("Give some user ids or filters, use coins>=0 to mean everyone.")
+
+                if args.command == "reset":
+                    accounts, coins = await reset_users(conn, selection)
+                else:
+                    accounts, coins = await adjust_users(conn, selection, args.amount)
+
+            print(f"Changed {accounts} account(s) by {coins:+} coins in total.")
+
+            # every running bot listens for this and drops the balances it has cached
+            stale = json.dumps({"sender": "admin", "stale": True})
+            await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, stale)
+            print("Told running bots to reload balances.")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.toml")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="write accounts to a .csv or .jsonl file")
+    export_parser.add_argument("path")
+    export_parser.add_argument("targets", nargs="*", help="user ids and filters, everyone if left out")
+
+    import_parser = commands.add_parser("import", help="load accounts from a .csv or .jsonl file")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--add", action="store_true", help="add to balances instead of replacing them")
+
+    reset_parser = commands.add_parser("reset", help="delete accounts")
+    reset_parser.add_argument("targets", nargs="+", help="user ids and filters")
+
+    adjust_parser = commands.add_parser("adjust", help="add or take away coins")
+    adjust_parser.add_argument("amount", type=int)
+    adjust_parser.add_argument("targets", nargs="+", help="user ids and filters")
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the thread and process image engines.
+
+    python -m benchmarks.filters [--renders 200] [--size 256] [--workers 2]
+
+Each mode renders the same emoji with every filter while a ticker measures how late the
+event loop wakes up, which is what the rest of the bot feels while filters run.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from cogs import images
+
+
+def make_emoji(size):
+    buffer = BytesIO()
+    Image.frombytes("RGBA", (size, size), os.urandom(size * size * 4)).save(buffer, "png")
+    return buffer.getvalue()
+
+
+async def ticker(lags, stop):
+    while not stop.is_set():
+        before = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - before - 0.001)
+
+
+async def run_mode(mode, args, emojis):
+    engine = images.ImageEngine(mode=mode, workers=args.workers, max_pending=args.workers * 2, timeout=60)
+
+    # spin the workers up first so process start-up isn't counted
+    await asyncio.gather(*(engine.render(-index, emojis[0], 0) for index in range(args.workers)))
+
+    lags = []
+    stop = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, stop))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        engine.render(index % len(emojis), emojis[index % len(emojis)], index % len(images.FILTERS))
+        for index in range(args.renders)
+    ))
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    await tick
+    engine.close()
+
+    lags.sort()
+    print(f"{mode:<8} {args.renders / elapsed:8.1f} renders/s   loop lag p50 {statistics.median(lags) * 1000:6.2f}ms"
+          f"  p99 {lags[int(len(lags) * 0.99)] * 1000:6.2f}ms  max {lags[-1] * 1000:6.2f}ms")
+
+
+async def main(args):
+    emojis = [make_emoji(args.size) for _ in range(args.emojis)]
+
+    for mode in ("thread", "process"):
+        await run_mode(mode, args, emojis)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--renders", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256, help="emoji width and height in pixels")
+    parser.add_argument("--emojis", type=int, default=8, help="distinct emojis to cycle through")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    asyncio.get_event_loop().run_until_complete(main(args))
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+"""
+Offline load test for CoinDrop, driven by a fake gateway.
+
+    python -m benchmarks.load [--rate 200] [--duration 30] [--channels 3] [--guessers 8]
+    python -m benchmarks.load --dsn postgresql://postgres@localhost/coindrop_bench
+
+Synthetic messages are dispatched to a DropBot that never logs in. Channel sends, deletes and
+CDN fetches are local fakes, and the database is either a real Postgres (``--dsn``) or an
+in-memory stand-in that understands the queries the bot makes.
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import random
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from io import BytesIO
+
+from PIL import Image
+
+import ledger
+from bot import DropBot
+from cogs import balances, leaderboard
+
+snowflakes = itertools.count(500000000000000000)
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """Thread pool that keeps track of how long its workers spend busy."""
+
+    def __init__(self, max_workers=None):
+        super().__init__(max_workers)
+        self.busy = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.busy += time.perf_counter() - started
+
+        return super().submit(timed)
+
+
+class FakeEmoji:
+    animated = False
+
+    def __init__(self, name):
+        self.id = next(snowflakes)
+        self.name = name
+        self.url = f"https://cdn.invalid/emojis/{self.id}.png"
+
+    def __str__(self):
+        return f"<:{self.name}:{self.id}>"
+
+
+class FakeGuild:
+    def __init__(self, emojis):
+        self.id = next(snowflakes)
+        self.emojis = emojis
+
+    def get_role(self, role_id):
+        return None
+
+
+class FakeMember:
+    # marked as a bot so Bot.on_message skips command processing, which needs a logged in user
+    bot = True
+
+    def __init__(self, guild):
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.mention = f"<@{self.id}>"
+
+    async def add_roles(self, *roles, reason=None):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content):
+        self.id = next(snowflakes)
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.created_at = datetime.datetime.utcnow()
+
+    async def delete(self):
+        await self.channel.api_call()
+        self.channel.deleted += 1
+
+    async def edit(self, *, content=None, **fields):
+        await self.channel.api_call()
+        self.content = content
+        self.channel.edited.append((time.monotonic(), content))
+
+
+class FakeChannel:
+    def __init__(self, guild, latency):
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.latency = latency
+        self.deleted = 0
+        self.api_calls = 0
+        self.sent = []  # (monotonic time, content, has file)
+        self.edited = []  # (monotonic time, content)
+
+    async def api_call(self):
+        self.api_calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def send(self, content=None, *, file=None, **fields):
+        await self.api_call()
+        self.sent.append((time.monotonic(), content, file is not None))
+        return FakeMessage(self, None, content)
+
+    async def delete_messages(self, messages):
+        await self.api_call()
+        self.deleted += len(messages)
+
+
+class FakeResponse:
+    def __init__(self, data, latency):
+        self.data = data
+        self.latency = latency
+
+    async def __aenter__(self):
+        await asyncio.sleep(self.latency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    async def read(self):
+        return self.data
+
+
+class FakeSession:
+    def __init__(self, latency):
+        self.latency = latency
+        self.fetches = 0
+
+        buffer = BytesIO()
+        Image.new("RGBA", (128, 128), (255, 200, 0, 255)).save(buffer, "png")
+        self.data = buffer.getvalue()
+
+    def get(self, url):
+        self.fetches += 1
+        return FakeResponse(self.data, self.latency)
+
+    async def close(self):
+        pass
+
+
+class FakeConnection:
+    """Just enough of an asyncpg connection for the queries the bot sends."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetch(self, query, *args):
+        await asyncio.sleep(self.pool.latency)
+        table = self.pool.table
+
+        if query == ledger.UPSERT_COINS:
+            self.pool.upserts += len(args[0])
+            totals = {}
+            for _, user_id, amount, *_ in zip(*args):
+                totals[user_id] = table[user_id] = table.get(user_id, 0) + amount
+            return [{"user_id": user_id, "coins": coins} for user_id, coins in totals.items()]
+
+        if query == leaderboard.FETCH_TOP:
+            ordered = sorted(table.items(), key=lambda item: (-item[1], item[0]))[:args[0]]
+            return [{"user_id": user_id, "coins": coins} for user_id, coins in ordered]
+
+        raise NotImplementedError(query)
+
+    async def fetchval(self, query, *args):
+        await asyncio.sleep(self.pool.latency)
+        table = self.pool.table
+
+        if query == balances.FETCH_BALANCE:
+            return table.get(args[0])
+
+        if query == leaderboard.COUNT_AHEAD:
+            return sum(1 for coins in table.values() if coins > args[0])
+
+        raise NotImplementedError(query)
+
+    async def execute(self, query, *args):
+        raise NotImplementedError(query)
+
+
+class FakePool:
+    def __init__(self, latency, max_size=20):
+        self.latency = latency
+        self.table = {}
+        self.upserts = 0
+        self.max_size = max_size
+        self.semaphore = asyncio.Semaphore(max_size)
+
+    @asynccontextmanager
+    async def acquire(self):
+        async with self.semaphore:
+            yield FakeConnection(self)
+
+    def get_size(self):
+        return self.max_size
+
+    def get_idle_size(self):
+        return self.semaphore._value
+
+    def get_max_size(self):
+        return self.max_size
+
+    async def close(self):
+        pass
+
+
+class BenchBot(DropBot):
+    def __init__(self, *args, guilds, dsn=None, db_latency=0.0, **kwargs):
+        self.guilds_by_id = {guild.id: guild for guild in guilds}
+        self.emojis_by_id = {emoji.id: emoji for guild in guilds for emoji in guild.emojis}
+        self.dsn = dsn
+        self.db_latency = db_latency
+        super().__init__(*args, **kwargs)
+
+    async def acquire_pool(self, credentials):
+        if self.dsn is None:
+            self.db = FakePool(self.db_latency)
+            self.db_available.set()
+            self.startup_step_done("database")
+        else:
+            await self.connect_pool({"dsn": self.dsn})
+
+    def get_guild(self, guild_id):
+        return self.guilds_by_id.get(guild_id)
+
+    def get_emoji(self, emoji_id):
+        return self.emojis_by_id.get(emoji_id)
+
+    async def wait_until_ready(self):
+        pass
+
+
+async def guess(bot, channel, drop, members, delay_range):
+    answer = random.choice(sorted(drop.answers))
+    delays = sorted(random.uniform(*delay_range) for _ in members)
+
+    first = None
+    started = time.monotonic()
+    for member, delay in zip(members, delays):
+        await asyncio.sleep(max(started + delay - time.monotonic(), 0))
+        first = first or time.monotonic()
+        bot.dispatch("message", FakeMessage(channel, member, answer))
+
+    return first
+
+
+async def run(args):
+    loop = asyncio.get_event_loop()
+    executor = InstrumentedExecutor()
+    loop.set_default_executor(executor)
+
+    names = ["blobthinking", "blobowo", "googlecat", "ablobwave", "blobaww", "thinkingblob", "blobnom"]
+    guilds = [FakeGuild([FakeEmoji(f"{name}{index}") for index, name in enumerate(names * 4)]) for _ in range(3)]
+    members = [FakeMember(guilds[0]) for _ in range(args.users)]
+    channels = [FakeChannel(guilds[0], args.api_latency / 1000) for _ in range(args.channels)]
+
+    config = {
+        "drop_channels": [channel.id for channel in channels],
+        "emoji_sources": [guild.id for guild in guilds],
+        "cooldown_time": args.cooldown,
+        "drops_per_hour": 3600 / args.cooldown,
+        "schedule_interval": 1,
+        "additional_delay": args.additional_delay,
+        "asset_path": tempfile.mkdtemp(prefix="coindrop-bench-"),
+        "image_engine": args.image_engine,
+    }
+
+    bot = BenchBot('.', config=config, guilds=guilds, dsn=args.dsn, db_latency=args.db_latency / 1000)
+    await bot.session.close()
+    bot.session = FakeSession(args.cdn_latency / 1000)
+    bot.load_extension("cogs.coindrop")
+    await bot.db_available.wait()
+    bot.dispatch("ready")
+
+    cog = bot.get_cog("CoinDrop")
+    channels_by_id = {channel.id: channel for channel in channels}
+    seen_drops = set()
+    guess_tasks = []
+
+    chatter = ["hello", "how is everyone doing today", "lol", "did anyone see that", "nice", "brb"]
+    interval = 1 / args.rate if args.rate else 0
+    dispatched = 0
+    lag = []
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    next_message = started
+
+    while time.monotonic() < deadline:
+        channel = random.choice(channels)
+        bot.dispatch("message", FakeMessage(channel, random.choice(members), random.choice(chatter)))
+        dispatched += 1
+
+        # start a crowd of guessers for every drop that's gone out
+        for channel_id, state in cog.channels.items():
+            drop = state.drop
+            if drop is not None and drop.coin_id not in seen_drops:
+                seen_drops.add(drop.coin_id)
+                crowd = random.sample(members, min(args.guessers, len(members)))
+                guess_tasks.append((channels_by_id[channel_id], drop, loop.create_task(
+                    guess(bot, channels_by_id[channel_id], drop, crowd, (0.2, args.additional_delay * 1.5))
+                )))
+
+        next_message += interval
+        before = time.monotonic()
+        await asyncio.sleep(max(next_message - before, 0))
+        lag.append(max(time.monotonic() - max(next_message, before), 0))
+
+    elapsed = time.monotonic() - started
+
+    # let the last drops settle and the ledger drain
+    await asyncio.sleep(args.additional_delay + 2)
+    await bot.ledger.flush()
+
+    pick_latencies = []
+    for channel, drop, task in guess_tasks:
+        if not task.done() or task.result() is None:
+            continue
+        acks = [sent_at for sent_at, content, *_ in channel.sent + channel.edited
+                if content and "That's the one" in content and sent_at >= task.result()]
+        if acks:
+            pick_latencies.append(acks[0] - task.result())
+
+    grants = sum(count for (event,), count in cog.drop_events.values.items()
+                 if event in ("pick", "additional_pick"))
+
+    print(f"duration            {elapsed:.1f}s")
+    print(f"messages            {dispatched} ({dispatched / elapsed:.0f}/s)")
+    print(f"loop lag            p50 {statistics.median(lag) * 1000:.2f}ms, max {max(lag) * 1000:.2f}ms")
+    print(f"drops               {len(seen_drops)}")
+    for (event,), count in sorted(cog.drop_events.values.items()):
+        print(f"  {event:<18}{count}")
+    if pick_latencies:
+        print(f"guess to ack        p50 {statistics.median(pick_latencies) * 1000:.1f}ms, "
+              f"max {max(pick_latencies) * 1000:.1f}ms")
+    print(f"coin grants         {grants} ({grants / elapsed:.1f}/s)")
+    print(f"discord calls       {sum(channel.api_calls for channel in channels)} "
+          f"({sum(channel.deleted for channel in channels)} messages deleted)")
+    if isinstance(bot.db, FakePool):
+        print(f"rows upserted       {bot.db.upserts}")
+    print(f"cdn fetches         {bot.session.fetches}")
+    workers = executor._max_workers
+    print(f"executor busy       {executor.busy:.2f}s over {workers} workers "
+          f"({executor.busy / (elapsed * workers) * 100:.1f}% utilization)")
+    filter_time = cog.phase_time.values.get(("filter",))
+    if filter_time:
+        print(f"image filters       {filter_time[-1]} renders, {filter_time[-2]:.2f}s ({args.image_engine} engine)")
+
+    for task in (task for _, _, task in guess_tasks):
+        task.cancel()
+    bot.remove_cog("CoinDrop")
+    await bot.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rate", type=float, default=200, help="messages per second, 0 for as fast as possible")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send messages for")
+    parser.add_argument("--channels", type=int, default=3)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--guessers", type=int, default=8, help="users who try to guess each drop")
+    parser.add_argument("--cooldown", type=float, default=5)
+    parser.add_argument("--additional-delay", type=float, default=3)
+    parser.add_argument("--api-latency", type=float, default=50, help="milliseconds per fake discord API call")
+    parser.add_argument("--cdn-latency", type=float, default=80, help="milliseconds per fake CDN fetch")
+    parser.add_argument("--db-latency", type=float, default=1, help="milliseconds per stand-in query")
+    parser.add_argument("--image-engine", choices=("thread", "process"), default="process")
+    parser.add_argument("--dsn", default=None, help="run against this Postgres instead of the stand-in")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(run(args))
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-message cost of CoinDrop.on_message for messages that aren't guesses.
+
+    python -m benchmarks.on_message [--messages 200000]
+
+The legacy path is a copy of the pre-DropState hot path, kept here for comparison.
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+from types import SimpleNamespace
+
+import metrics
+from configuration import Config
+from cogs.catalog import CatalogEntry
+from cogs import drops
+from cogs.coindrop import CoinDrop
+from cogs.drops import DropState
+
+DROP_CHANNEL = 357651359379750917
+OTHER_CHANNEL = 272885620769161216
+
+
+class FakeEmoji(SimpleNamespace):
+    def __str__(self):
+        return f"<:{self.name}:{self.id}>"
+
+
+def make_message(channel_id, content, author_id=1):
+    return SimpleNamespace(
+        content=content,
+        channel=SimpleNamespace(id=channel_id),
+        author=SimpleNamespace(id=author_id),
+    )
+
+
+async def legacy_on_message(bot, state, message):
+    max_additional_delay = bot.config.get("additional_delay", 10)
+
+    immediate_time = time.monotonic()
+    if (message.content.lower().strip().replace(' ', '') in state.blob_options and
+            immediate_time < (state.last_drop + max_additional_delay)):
+        if message.author.id not in state.additional_pickers:
+            return
+
+    if state.no_drops:
+        return
+
+    if message.content.startswith("."):
+        return
+
+    if message.channel.id not in bot.config.get("drop_channels", []):
+        return
+
+    if state.drop_lock.locked():
+        return
+
+
+def run_coroutine(coro):
+    try:
+        coro.send(None)
+    except StopIteration:
+        pass
+    else:
+        raise RuntimeError("on_message suspended, this message isn't on the fast path")
+
+
+def measure(name, handler, messages, count):
+    start = time.perf_counter()
+    for index in range(count):
+        handler(messages[index % len(messages)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed / count * 1e9:8.1f} ns/message")
+
+
+async def main(count):
+    bot = SimpleNamespace(
+        config=Config({
+            "drop_channels": [DROP_CHANNEL, 357651359379750918, 357651359379750919],
+            "additional_delay": 10,
+            "asset_path": tempfile.mkdtemp(),
+        }),
+        loop=asyncio.get_event_loop(),
+        logger=logging.getLogger("dropbot"),
+        metrics=metrics.Registry(),
+        add_startup_step=lambda name: None,
+        get_guild=lambda guild_id: None,
+        started=asyncio.Event(),
+        wait_until_ready=asyncio.get_event_loop().create_future,
+        is_closed=lambda: True,
+    )
+    cog = CoinDrop(bot)
+
+    emoji = CatalogEntry(FakeEmoji(name="blobthinkingeyes", id=396144014128054275, url=""), OTHER_CHANNEL)
+    state = cog.channels[DROP_CHANNEL]
+    state.drop = DropState("0" * 16, DROP_CHANNEL, emoji, time.monotonic(), 10, "coin", "coins")
+    state.phase = drops.LIVE
+
+    drop_lock = asyncio.Lock()
+    await drop_lock.acquire()
+
+    legacy_state = SimpleNamespace(
+        blob_options=sorted(state.drop.answers),
+        last_drop=state.drop.dropped_at,
+        additional_pickers=list(range(20)),
+        no_drops=False,
+        drop_lock=drop_lock,
+    )
+
+    chatter = ["hello there", "has anyone seen the new blobs", "lol", "this is a much longer message " * 4]
+    workloads = {
+        "other channels": [make_message(OTHER_CHANNEL, text) for text in chatter],
+        "drop channel": [make_message(DROP_CHANNEL, text) for text in chatter],
+    }
+
+    for workload, messages in workloads.items():
+        print(f"-- {workload}")
+        measure("legacy", lambda m: run_coroutine(legacy_on_message(bot, legacy_state, m)), messages, count)
+        measure("on_message", lambda m: run_coroutine(cog.on_message(m)), messages, count)
+
+    cog.cog_unload()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args.messages))
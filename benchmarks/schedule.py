@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Replays message timestamps through the drop scheduler to see how settings would play out.
+
+    python -m benchmarks.schedule [timestamps.txt] [--drops-per-hour 30] [--active-rate 10] ...
+
+The file has one message per line, as unix seconds or an ISO 8601 time (for instance
+exported from a drop channel's history). Without one, a synthetic day of traffic is used.
+"""
+import argparse
+import bisect
+import datetime
+import math
+import random
+import statistics
+
+from cogs.scheduler import DropScheduler, simulate
+
+
+def parse_time(text):
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.datetime.fromisoformat(text).timestamp()
+
+
+def load_timestamps(path):
+    with open(path, "r", encoding="utf-8") as fp:
+        return sorted(parse_time(line.strip()) for line in fp if line.strip())
+
+
+def synthetic_day(rng):
+    """A day where activity swings from a couple of messages an hour to a busy evening, with bursts."""
+    timestamps = []
+    now = 0.0
+
+    while now < 86400:
+        hour = now / 3600
+        per_minute = 0.05 + 20 * max(math.sin((hour - 8) / 24 * 2 * math.pi), 0) ** 3
+        if rng.random() < 0.02:
+            per_minute *= 5  # someone started a conversation
+
+        now += rng.expovariate(per_minute / 60)
+        timestamps.append(now)
+
+    return timestamps
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    timestamps = load_timestamps(args.timestamps) if args.timestamps else synthetic_day(rng)
+
+    scheduler = DropScheduler(args.drops_per_hour, args.active_rate, args.half_life, rng=rng)
+    dropped = simulate(scheduler, timestamps, cooldown=args.cooldown, tick=args.tick)
+
+    hours = (timestamps[-1] - timestamps[0]) / 3600
+    print(f"messages            {len(timestamps)} over {hours:.1f}h")
+    print(f"drops               {len(dropped)} ({len(dropped) / hours:.1f}/h)")
+
+    if len(dropped) > 1:
+        gaps = [later - earlier for earlier, later in zip(dropped, dropped[1:])]
+        between = [bisect.bisect_left(timestamps, later) - bisect.bisect_left(timestamps, earlier)
+                   for earlier, later in zip(dropped, dropped[1:])]
+        print(f"time between drops  median {statistics.median(gaps) / 60:.1f}min, min {min(gaps):.0f}s")
+        print(f"messages per drop   median {statistics.median(between):.0f}, min {min(between)}")
+
+    # how drops followed activity, hour by hour
+    start = timestamps[0]
+    by_hour = {}
+    for when in timestamps:
+        by_hour.setdefault(int((when - start) // 3600), [0, 0])[0] += 1
+    for when in dropped:
+        by_hour[int((when - start) // 3600)][1] += 1
+
+    print("hour  messages  drops")
+    for hour, (messages, drops) in sorted(by_hour.items()):
+        print(f"{hour:>4}  {messages:>8}  {drops:>5}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("timestamps", nargs="?", help="file of message timestamps, one per line")
+    parser.add_argument("--drops-per-hour", type=float, default=30)
+    parser.add_argument("--active-rate", type=float, default=10, help="messages per minute for the full drop rate")
+    parser.add_argument("--half-life", type=float, default=60, help="seconds")
+    parser.add_argument("--cooldown", type=float, default=20)
+    parser.add_argument("--tick", type=float, default=5, help="seconds between scheduler ticks")
+    parser.add_argument("--seed", type=int, default=None)
+
+    main(parser.parse_args())
@@ -3,7 +3,10 @@
 import asyncio
 import hashlib
 import logging
+import os
+import time
 import traceback
+from contextlib import asynccontextmanager
 
 import aiohttp
 import asyncpg
@@ -11,31 +14,315 @@ import asyncpg
 import discord
 from discord.ext import commands
 
+import database
+import metrics
+from configuration import RESTART_REQUIRED, Config, ConfigError
+from coordination import Coordinator
+from events import EventLog
+from ledger import CoinLedger
+
+
+MIGRATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# arbitrary, just has to be the same for every process running migrations
+MIGRATIONS_LOCK = 0x636f696e
+
+# what has to be done before the bot starts dropping; extensions add their own with add_startup_step
+STARTUP_STEPS = ("database", "gateway")
+
 
 class DropBot(commands.Bot):
-    def __init__(self, *args, config=None, **kwargs):
+    def __init__(self, *args, config=None, config_path=None, cluster=None, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.config = config or {}
+        config = dict(config or {})
+        credentials = config.pop("database", None)
+
+        self.config = Config(config)
+        self.config_path = config_path
+        self.cluster = cluster  # index into ``clusters``, or None when running as one process
+        self._drop_guilds = None
+        self.started_at = time.perf_counter()
+        self.startup_steps = dict.fromkeys(STARTUP_STEPS)  # step: seconds after start it finished
+        self.started = asyncio.Event()
         self.db = None
+        self.coordinator = None
+        self.listener = None
+        self.events = EventLog(
+            self,
+            archive_path=self.config.get("event_archive_path", "archive"),
+            retention_months=self.config.get("event_retention_months", 6)
+        )
         self.db_available = asyncio.Event()
         self.logger = logging.getLogger("dropbot")
         self.session = aiohttp.ClientSession(loop=self.loop)
+        self.ledger = CoinLedger(
+            self,
+            interval=self.config.get("ledger_flush_interval", 0.25),
+            max_batch=self.config.get("ledger_batch_size", 50)
+        )
+
+        self.metrics = metrics.Registry()
+        self.metrics_runner = None
+        self.pool_wait = self.metrics.histogram("coindrop_pool_acquire_seconds",
+                                                "Time spent waiting for a database connection")
+        self.db_time = self.metrics.histogram("coindrop_db_seconds", "Database query time",
+                                              labels=("operation",))
+        self.command_time = self.metrics.histogram("coindrop_command_seconds", "Command run time",
+                                                   labels=("command", "outcome"))
+        self.metrics.gauge("coindrop_pool_connections", "Database connections by state", self.pool_connections,
+                           labels=("state",))
+        self.metrics.gauge("coindrop_ledger_pending", "Coin grants waiting to be written",
+                           lambda: self.ledger.pending_count)
+        self.metrics.gauge("coindrop_db_available", "Whether the database pool is up",
+                           lambda: int(self.db_available.is_set()))
+        self.pool_rebuilds = self.metrics.counter("coindrop_pool_rebuilds_total",
+                                                  "Times the database pool was rebuilt after failing")
+
+        self.pool_task = self.loop.create_task(self.acquire_pool(credentials))
+
+        if "metrics_port" in self.config:
+            self.loop.create_task(self.start_metrics())
+
+        if config_path is not None:
+            self.loop.create_task(self.watch_config())
+
+    def reload_config(self):
+        """Reads the config file again and swaps the new snapshot in. Raises ConfigError if it's invalid."""
+        new = Config.from_file(self.config_path)
+
+        # cogs build what they work out from the config first, so one they can't use changes nothing
+        try:
+            prepared = [(cog, cog.prepare_config(new)) for cog in self.cogs.values() if hasattr(cog, "prepare_config")]
+        except (ValueError, ArithmeticError) as error:
+            raise ConfigError(f"Can't use the new config: {error}") from error
+
+        old, self.config = self.config, new
+        for cog, state in prepared:
+            cog.apply_config(new, state)
+
+        changed = old.changed(new)
+        needs_restart = [key for key in changed if key in RESTART_REQUIRED]
+
+        self.logger.info(f"Reloaded config, changed: {', '.join(changed) or 'nothing'}")
+        if needs_restart:
+            self.logger.warning(f"Changes to {', '.join(needs_restart)} only take effect after a restart.")
+
+        self.dispatch("config_reload", old, new)
+        return changed
+
+    async def watch_config(self):
+        interval = self.config.get("config_watch_interval", 5)
+        modified = os.stat(self.config_path).st_mtime
+
+        while not self.is_closed():
+            await asyncio.sleep(interval)
+
+            try:
+                current = os.stat(self.config_path).st_mtime
+                if current == modified:
+                    continue
+
+                modified = current
+                self.reload_config()
+            except (OSError, ConfigError):
+                self.logger.exception("Couldn't reload the config, keeping the current one.")
+
+    def drop_guild_ids(self) -> frozenset:
+        """Ids of the guilds that have a drop channel, worked out once per config snapshot."""
+        config = self.config
+        if self._drop_guilds is not None and self._drop_guilds[0] is config:
+            return self._drop_guilds[1]
+
+        channels = [self.get_channel(channel_id) for channel_id in config.drop_channels]
+        guild_ids = frozenset(channel.guild.id for channel in channels if channel is not None)
+
+        # channels we can't see yet might just not be loaded, so try again next time
+        if None not in channels:
+            self._drop_guilds = (config, guild_ids)
+
+        return guild_ids
+
+    def add_startup_step(self, name: str):
+        self.startup_steps.setdefault(name, None)
+
+    def startup_step_done(self, name: str):
+        if self.startup_steps.get(name) is not None:
+            return
+
+        self.startup_steps[name] = time.perf_counter() - self.started_at
+
+        if self.started.is_set() or None in self.startup_steps.values():
+            return
+
+        report = ", ".join(f"{step} {elapsed:.2f}s" for step, elapsed
+                           in sorted(self.startup_steps.items(), key=lambda item: item[1]))
+        self.logger.info(f"Started in {max(self.startup_steps.values()):.2f}s ({report})")
+        self.started.set()
+
+    async def login(self, *args, **kwargs):
+        await super().login(*args, **kwargs)
+        self.logger.info(f"Logged in after {time.perf_counter() - self.started_at:.2f}s")
+
+    async def on_ready(self):
+        self.startup_step_done("gateway")
+
+    async def start_metrics(self):
+        host = self.config.get("metrics_host", "127.0.0.1")
+        # each cluster serves its own metrics, so they can't all bind the same port
+        port = self.config["metrics_port"] + (self.cluster or 0)
 
-        self.loop.create_task(self.acquire_pool())
+        try:
+            self.metrics_runner = await metrics.start_server(self.metrics, host, port)
+        except OSError:
+            self.logger.exception(f"Couldn't serve metrics on {host}:{port}")
+            return
 
-    async def acquire_pool(self):
-        credentials = self.config.pop("database")
+        self.logger.info(f"Serving metrics on http://{host}:{port}/metrics")
 
+    def pool_connections(self):
+        if self.db is None:
+            return {}
+
+        idle = self.db.get_idle_size()
+        return {"in_use": self.db.get_size() - idle, "idle": idle, "max": self.db.get_max_size()}
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        async with self.db.acquire() as conn:
+            self.pool_wait.observe(time.perf_counter() - started)
+            yield conn
+
+    async def acquire_pool(self, credentials):
         if not credentials:
             self.logger.critical("Cannot connect to db, no credentials!")
             await self.logout()
+            return
+
+        # even a single process listens, so balances changed with admin.py don't stay cached
+        self.listener = Coordinator(self, database.connect_options(credentials))
+        self.listener.start()
+
+        if self.config.get("clusters"):
+            self.coordinator = self.listener
+
+        await self.connect_pool(credentials)
+        self.events.start()
+
+        health_interval = self.config.get("db_health_interval", 15)
+
+        while not self.is_closed():
+            await asyncio.sleep(health_interval)
+
+            if await self.pool_healthy(credentials):
+                continue
 
-        self.db = await asyncpg.create_pool(**credentials)
+            self.logger.warning("Database health check failed, rebuilding the pool.")
+            self.pool_rebuilds.inc()
+            self.db_available.clear()
+            self.db.terminate()
+            await self.connect_pool(credentials)
+
+    async def connect_pool(self, credentials):
+        """Migrates and opens the pool, retrying with backoff until it works, then sets db_available."""
+        delay = 1
+
+        while True:
+            try:
+                # migrate on a plain connection first, since the pool prepares statements against the new schema
+                conn = await asyncpg.connect(**database.connect_options(credentials))
+                try:
+                    await self.apply_migrations(conn)
+                    await self.events.ensure_partitions(conn)
+                finally:
+                    await conn.close()
+
+                self.db = await database.create_pool(credentials)
+                break
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                self.logger.exception(f"Couldn't connect to the database, retrying in {delay} seconds.")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+        self.logger.info(f"Database pool ready with {self.db.get_size()} connections.")
         self.db_available.set()
+        self.startup_step_done("database")
+
+    async def pool_healthy(self, credentials) -> bool:
+        # checked on a connection of its own, so a pool that's only busy isn't mistaken for a dead database
+        try:
+            conn = await asyncpg.connect(**database.connect_options(credentials), timeout=10)
+            try:
+                await conn.fetchval("SELECT 1", timeout=5)
+            finally:
+                await conn.close(timeout=5)
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            return False
+        return True
+
+    async def apply_migrations(self, conn):
+        await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+        )
+        """)
+
+        # several shard processes may be starting at once
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK)
+
+        try:
+            applied = {record["name"] for record in await conn.fetch("SELECT name FROM schema_migrations")}
+
+            for name in sorted(os.listdir(MIGRATIONS_PATH)):
+                if not name.endswith(".sql") or name in applied:
+                    continue
+
+                with open(os.path.join(MIGRATIONS_PATH, name), "r", encoding="utf-8") as fp:
+                    migration = fp.read()
+
+                async with conn.transaction():
+                    await conn.execute(migration)
+                    await conn.execute("INSERT INTO schema_migrations (name) VALUES ($1)", name)
+
+                self.logger.info(f"Applied migration {name}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK)
+
+    async def close(self):
+        await super().close()
+        self.pool_task.cancel()
+
+        # the gateway is down, so nothing else can be granted; make sure what we have is written
+        if self.db_available.is_set():
+            await self.ledger.close()
+            await self.events.close()
+            if self.listener is not None:
+                await self.listener.close()
+            await self.db.close()
+        elif self.ledger.pending:
+            self.logger.critical(f"Shutting down without a db, {self.ledger.pending_count} coin grant(s) lost.")
+
+        await self.session.close()
+
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+    async def on_command(self, ctx: commands.Context):
+        ctx.started_at = time.perf_counter()
+
+    async def on_command_completion(self, ctx: commands.Context):
+        self.command_time.observe(time.perf_counter() - ctx.started_at, command=ctx.command.qualified_name,
+                                  outcome="completed")
 
     async def on_command_error(self, ctx: commands.Context, exception):
         msg = ctx.message
+
+        if hasattr(ctx, "started_at"):
+            self.command_time.observe(time.perf_counter() - ctx.started_at, command=ctx.command.qualified_name,
+                                      outcome="failed")
+
         if isinstance(exception, (commands.CommandOnCooldown, commands.CommandNotFound,
                                   commands.DisabledCommand, commands.MissingPermissions,
                                   commands.CheckFailure)):
@@ -57,3 +344,7 @@ class DropBot(commands.Bot):
         if user.id in self.config.get("admin_users", []):
             return True
         return await super().is_owner(user)
+
+
+class ShardedDropBot(DropBot, commands.AutoShardedBot):
+    pass
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+class AssetStore:
+    """Content-addressed on-disk store for emoji images.
+
+    Images live in ``objects/`` named after the sha256 of the raw emoji, with filtered
+    variants stored next to them. ``index.json`` maps emoji ids to that digest, so the
+    store survives restarts and nothing needs to be fetched twice.
+    Reads return the file's bytes and keep nothing open, so the store costs no file
+    descriptors however many emojis it holds; the OS page cache keeps repeat reads cheap.
+    Writes come from executor threads as well as the event loop, so they hold ``lock``.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.index_path = os.path.join(root, "index.json")
+        self.lock = threading.Lock()
+
+        os.makedirs(self.objects, exist_ok=True)
+
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as fp:
+                self.index = {int(key): value for key, value in json.load(fp).items()}
+        except (OSError, ValueError):
+            self.index = {}
+
+    def __contains__(self, emoji_id):
+        return emoji_id in self.index
+
+    def _read(self, name: str):
+        try:
+            with open(os.path.join(self.objects, name), "rb") as fp:
+                return fp.read() or None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _replace(path: str, data: bytes):
+        # a temp file of its own next to the target, so concurrent writers never share one
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+    def _write(self, name: str, data: bytes):
+        path = os.path.join(self.objects, name)
+        if not os.path.exists(path):  # content-addressed, so whatever is there is already right
+            self._replace(path, data)
+
+    def _save_index(self):
+        self._replace(self.index_path, json.dumps(self.index).encode("utf-8"))
+
+    def emoji_ids(self) -> list:
+        with self.lock:
+            return list(self.index)
+
+    def raw(self, emoji_id: int):
+        digest = self.index.get(emoji_id)
+        return None if digest is None else self._read(f"{digest}.png")
+
+    def filtered(self, emoji_id: int, filter_index: int):
+        digest = self.index.get(emoji_id)
+        return None if digest is None else self._read(f"{digest}-{filter_index}.png")
+
+    def put_raw(self, emoji_id: int, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+
+        with self.lock:
+            self._write(f"{digest}.png", data)
+
+            if self.index.get(emoji_id) != digest:
+                self.index[emoji_id] = digest
+                self._save_index()
+
+        return digest
+
+    def put_filtered(self, emoji_id: int, filter_index: int, data: bytes):
+        with self.lock:
+            digest = self.index.get(emoji_id)
+            if digest is not None:
+                self._write(f"{digest}-{filter_index}.png", data)
+
+    def forget(self, emoji_ids):
+        """Drops emojis from the index. Their objects stay on disk until :meth:`prune`."""
+        with self.lock:
+            removed = [emoji_id for emoji_id in emoji_ids if self.index.pop(emoji_id, None) is not None]
+            if removed:
+                self._save_index()
+
+    def prune(self):
+        """Deletes objects no longer referenced by the index."""
+        with self.lock:
+            live = set(self.index.values())
+
+            for name in os.listdir(self.objects):
+                if name.endswith(".tmp"):
+                    continue  # still being written, maybe by another process sharing the store
+                if name.split("-", 1)[0].split(".", 1)[0] not in live:
+                    try:
+                        os.remove(os.path.join(self.objects, name))
+                    except OSError:
+                        pass
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+
+FETCH_BALANCE = "SELECT coins FROM currency_users WHERE user_id = $1"
+
+# balances can't go negative (see no_debt_please), so this marks a user without a row
+NO_ACCOUNT = -1
+
+
+class BalanceCache:
+    """Bounded LRU of user id -> coin balance, read through from currency_users."""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    async def get(self, db, user_id: int):
+        """Returns the user's balance, or None if they have no account.
+
+        ``db`` is anything with an ``acquire()`` async context manager, like the bot or its pool.
+        """
+        coins = self.entries.get(user_id)
+
+        if coins is None:
+            self.misses += 1
+
+            async with db.acquire() as conn:
+                coins = await conn.fetchval(FETCH_BALANCE, user_id)
+
+            # a grant may have landed while we were waiting, and that one is newer
+            coins = self.entries.setdefault(user_id, NO_ACCOUNT if coins is None else coins)
+            self.trim()
+        else:
+            self.hits += 1
+
+        self.entries.move_to_end(user_id)
+        return None if coins == NO_ACCOUNT else coins
+
+    def set(self, user_id: int, coins: int):
+        self.entries[user_id] = coins
+        self.entries.move_to_end(user_id)
+        self.trim()
+
+    def invalidate(self, user_id: int):
+        self.entries.pop(user_id, None)
+
+    def trim(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
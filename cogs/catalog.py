@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import random
+
+from .drops import answers_for
+
+
+class CatalogEntry:
+    """A droppable emoji, with its accepted answers worked out ahead of time."""
+
+    __slots__ = ("id", "name", "text", "url", "guild_id", "answers")
+
+    def __init__(self, emoji, guild_id: int):
+        self.id = emoji.id
+        self.name = emoji.name
+        self.text = str(emoji)
+        self.url = str(emoji.url)
+        self.guild_id = guild_id
+        self.answers = answers_for(emoji)
+
+    def __str__(self):
+        return self.text
+
+    def __repr__(self):
+        return f"<CatalogEntry id={self.id} name={self.name!r} guild_id={self.guild_id}>"
+
+
+class EmojiCatalog:
+    """Every droppable emoji from the source guilds.
+
+    Guilds are added and replaced as a whole when their emojis change. Selection is
+    weighted per guild and uses an alias table (rebuilt lazily after changes), so picking
+    an emoji costs the same however many guilds and emojis there are.
+    """
+
+    def __init__(self, guild_weights: dict = None):
+        self.guild_weights = guild_weights or {}
+        self.entries = {}
+        self.guilds = {}  # guild id: set of emoji ids
+        self._table = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, emoji_id):
+        return emoji_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, emoji_id: int):
+        return self.entries.get(emoji_id)
+
+    def set_guild(self, guild_id: int, emojis):
+        self.remove_guild(guild_id)
+
+        entries = [CatalogEntry(emoji, guild_id) for emoji in emojis if not emoji.animated]
+        self.entries.update((entry.id, entry) for entry in entries)
+        self.guilds[guild_id] = {entry.id for entry in entries}
+        self._table = None
+
+    def remove_guild(self, guild_id: int):
+        for emoji_id in self.guilds.pop(guild_id, ()):
+            del self.entries[emoji_id]
+        self._table = None
+
+    def _build_table(self):
+        entries = [entry for entry in self.entries.values() if self.guild_weights.get(entry.guild_id, 1) > 0]
+        weights = [self.guild_weights.get(entry.guild_id, 1) for entry in entries]
+
+        count = len(entries)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        probability = [1.0] * count
+        alias = list(range(count))
+
+        small = [index for index, value in enumerate(scaled) if value < 1]
+        large = [index for index, value in enumerate(scaled) if value >= 1]
+
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+        self._table = (entries, probability, alias)
+
+    def choose(self):
+        """Returns a random entry, weighted by guild, or None if there's nothing to choose from."""
+        if self._table is None:
+            self._build_table()
+
+        entries, probability, alias = self._table
+        if not entries:
+            return None
+
+        index = random.randrange(len(entries))
+        return entries[index] if random.random() < probability[index] else entries[alias[index]]
@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 
 import asyncio
-import itertools
+import datetime
+import os
 import random
 import time
+from concurrent.futures import BrokenExecutor
 from io import BytesIO
 
-from PIL import Image, ImageFilter
+import aiohttp
+import asyncpg
 
 import discord
 from discord.ext import commands
 
-from . import utils
+import admin
+import events
+from configuration import RESTART_REQUIRED, ConfigError
+from . import assets, balances, catalog, drops, images, leaderboard, outbox, rewards, scheduler, throttle, utils
 
 
 class Rollback(Exception):
@@ -23,203 +29,521 @@ class CoinDrop(commands.Cog):
         super().__init__()
 
         self.bot = bot
-        self.last_drop = time.monotonic()
-        self.wait_until = self.last_drop
-        self.drop_lock = asyncio.Lock()
-        self.acquire_lock = asyncio.Lock()
         self.no_drops = False
-        self.last_blob = None
-        self.blob_options = []
-        self.last_coin_id = None
-        self.additional_pickers = []
+        self.channels = {}
+        self.outboxes = {}
+        self.role_grants = rewards.RoleGrants(self.bot)
+        self.role_sync_lock = asyncio.Lock()
+        self.emoji_sources = frozenset()
+        self.catalog = catalog.EmojiCatalog()
+        self.renders = images.RenderCache(self.bot.config.get("prerender_pool", 64))
+        self.image_engine = images.ImageEngine(
+            mode=self.bot.config.get("image_engine", "process"),
+            workers=self.bot.config.get("image_workers", 2),
+            max_pending=self.bot.config.get("image_max_pending", 4),
+            timeout=self.bot.config.get("image_timeout", 10)
+        )
+        self.assets = assets.AssetStore(self.bot.config.get("asset_path", "assets"))
+        self.balances = balances.BalanceCache(self.bot.config.get("balance_cache_size", 10000))
+        self.leaderboard = leaderboard.Leaderboard(self.bot.config.get("leaderboard_size", 50))
+        self.leaderboard_lock = asyncio.Lock()
+        self.apply_config(self.bot.config, self.prepare_config(self.bot.config))
+        self.warm_task = None
+        self.prime_task = self.bot.loop.create_task(self.prime_renders())
+        self.prerender_task = self.bot.loop.create_task(self.prerender_loop())
+        self.schedule_task = self.bot.loop.create_task(self.schedule_loop())
+        self.source_task = self.bot.loop.create_task(self.source_loop())
+        self.bot.add_startup_step("catalog")
+
+        registry = self.bot.metrics
+        self.phase_time = registry.histogram("coindrop_drop_phase_seconds", "Time spent in each phase of a drop",
+                                             labels=("phase",))
+        self.drop_events = registry.counter("coindrop_drop_events_total", "Drops and what happened to them",
+                                            labels=("event",))
+        self.throttled_guesses = registry.counter("coindrop_throttled_guesses_total",
+                                                  "Messages ignored during a drop because their author was guessing "
+                                                  "too fast")
+        registry.gauge("coindrop_prerendered_blobs", "Filtered blobs ready to drop", lambda: len(self.renders))
+        registry.gauge("coindrop_balance_cache_lookups", "Balance cache lookups by result",
+                       lambda: {"hit": self.balances.hits, "miss": self.balances.misses}, labels=("result",))
+
+    def cog_unload(self):
+        self.prime_task.cancel()
+        self.prerender_task.cancel()
+        self.schedule_task.cancel()
+        self.source_task.cancel()
+        for state in self.channels.values():
+            if state.drop is not None and state.drop.expire_handle is not None:
+                state.drop.expire_handle.cancel()
+        self.image_engine.close()
+        if self.warm_task is not None:
+            self.warm_task.cancel()
+
+    def prepare_config(self, config):
+        """Builds the objects worked out from ``config``, without changing anything yet."""
+        return {
+            "rewards": rewards.RewardThresholds(config.get("reward_roles", {})),
+            "guess_limiter": throttle.GuessLimiter(config.get("guess_rate", 1), config.get("guess_burst", 3)),
+            "scheduler": scheduler.DropScheduler(
+                drops_per_hour=config.get("drops_per_hour", 30),
+                active_rate=config.get("active_message_rate", 10),
+                half_life=config.get("message_rate_half_life", 60)
+            ),
+        }
+
+    def apply_config(self, config, prepared):
+        """Switches to ``config`` and what :meth:`prepare_config` built from it, keeping drops in progress."""
+        self.channels = {channel_id: self.channels.get(channel_id) or drops.DropChannel(channel_id)
+                         for channel_id in config.drop_channels}
+        self.rewards = prepared["rewards"]
+        self.guess_limiter = prepared["guess_limiter"]
+        self.scheduler = prepared["scheduler"]
+
+        for channel_outbox in self.outboxes.values():
+            channel_outbox.delay = config.get("cleanup_delay", 1)
+
+        emoji_sources = frozenset(config.get("emoji_sources", [272885620769161216]))
+        guild_weights = {int(guild_id): weight for guild_id, weight in config.get("emoji_weights", {}).items()}
+
+        if emoji_sources != self.emoji_sources or guild_weights != self.catalog.guild_weights:
+            for guild_id in self.emoji_sources - emoji_sources:
+                self.renders.invalidate(self.catalog.guilds.get(guild_id, set()))
+
+            self.emoji_sources = emoji_sources
+            self.catalog = catalog.EmojiCatalog(guild_weights)
+            self.build_catalog()
+
+    def build_catalog(self):
+        for guild_id in self.emoji_sources:
+            guild = self.bot.get_guild(guild_id)
+            if guild is not None:
+                self.catalog.set_guild(guild.id, guild.emojis)
+
+    async def replace_source(self, guild_id, emojis):
+        removed = self.catalog.guilds.get(guild_id, set()) - {emoji.id for emoji in emojis}
+        self.renders.invalidate(removed)
+        self.catalog.set_guild(guild_id, emojis)
+
+        try:
+            await self.bot.loop.run_in_executor(None, self.assets.forget, removed)
+        except OSError:
+            self.bot.logger.exception(f"Failed to drop {len(removed)} removed emoji(s) from the asset store.")
+
+        await self.warm_assets([self.catalog.get(emoji.id) for emoji in emojis if emoji.id in self.catalog])
+
+    async def load_remote_sources(self):
+        """Loads the source guilds this process doesn't hold over HTTP, since it gets no gateway events for them."""
+        for guild_id in self.emoji_sources:
+            if self.bot.get_guild(guild_id) is not None:
+                continue
+
+            try:
+                guild = await self.bot.fetch_guild(guild_id)
+            except (discord.NotFound, discord.Forbidden):
+                # we were removed from it, and the cluster that held it may never have been told
+                self.renders.invalidate(self.catalog.guilds.get(guild_id, set()))
+                self.catalog.remove_guild(guild_id)
+                self.bot.logger.warning(f"Can't see emoji source {guild_id} any more, not dropping its emojis.")
+            except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+                self.bot.logger.warning(f"Failed to load emoji source {guild_id}, will retry later.")
+            else:
+                await self.replace_source(guild_id, guild.emojis)
+
+    async def fetch_emoji(self, emoji):
+        emoji_bytes = self.assets.raw(emoji.id)
+
+        if emoji_bytes is None:
+            with self.phase_time.time(phase="fetch"):
+                async with self.bot.session.get(str(emoji.url)) as resp:
+                    # an error page stored as the emoji would be served from the store forever
+                    resp.raise_for_status()
+                    emoji_bytes = await resp.read()
+
+            await self.bot.loop.run_in_executor(None, self.assets.put_raw, emoji.id, emoji_bytes)
+
+        return emoji_bytes
+
+    async def render_emoji(self, emoji, filter_index):
+        data = self.assets.filtered(emoji.id, filter_index)
+
+        if data is None:
+            emoji_bytes = await self.fetch_emoji(emoji)
+            try:
+                with self.phase_time.time(phase="filter"):
+                    data = await self.image_engine.render(emoji.id, emoji_bytes, filter_index)
+            except OSError:
+                # the stored image doesn't decode, so fetch it again next time rather than failing on it for good
+                await self.bot.loop.run_in_executor(None, self.assets.forget, [emoji.id])
+                raise
+            await self.bot.loop.run_in_executor(None, self.assets.put_filtered, emoji.id, filter_index, data)
+
+        self.renders.put(emoji.id, filter_index, data)
+        return data
+
+    def stored_renders(self, emoji_ids):
+        candidates = [(emoji_id, filter_index) for emoji_id in emoji_ids for filter_index in range(len(images.FILTERS))]
+        random.shuffle(candidates)
+
+        found = []
+        for emoji_id, filter_index in candidates:
+            data = self.assets.filtered(emoji_id, filter_index)
+            if data is not None:
+                found.append((emoji_id, filter_index, data))
+                if len(found) >= self.renders.max_size:
+                    break
+
+        return found
+
+    async def prime_renders(self):
+        """Fills the render pool from the asset store while the bot logs in, so drops can start at once."""
+        stored = await self.bot.loop.run_in_executor(None, self.stored_renders, self.assets.emoji_ids())
+
+        for emoji_id, filter_index, data in stored:
+            self.renders.put(emoji_id, filter_index, data)
+
+        if stored:
+            self.bot.logger.info(f"Loaded {len(stored)} pre-rendered blob(s) from the asset store.")
+
+    async def warm_assets(self, emojis):
+        fetched = 0
+
+        for emoji in emojis:
+            if emoji.id in self.assets:
+                continue
+
+            try:
+                await self.fetch_emoji(emoji)
+            except (aiohttp.ClientError, OSError):
+                self.bot.logger.warning(f"Failed to store {emoji!r}, will fetch it on demand.")
+            else:
+                fetched += 1
+
+        if fetched:
+            self.bot.logger.info(f"Stored {fetched} new emoji(s) in the asset store.")
 
     @commands.Cog.listener()
-    async def on_message(self, message):
-        max_additional_delay = self.bot.config.get("additional_delay", 10)
+    async def on_ready(self):
+        if self.warm_task is not None and not self.warm_task.done():
+            return
+
+        self.build_catalog()
+
+        async def warm():
+            await self.load_remote_sources()
+            self.bot.startup_step_done("catalog")
+
+            await self.warm_assets(list(self.catalog))
+
+            # only clean up when every source guild is visible, or we'd throw away a guild that's just unavailable
+            if len(self.catalog.guilds) == len(self.emoji_sources):
+                stale = [emoji_id for emoji_id in self.assets.emoji_ids() if emoji_id not in self.catalog]
+                try:
+                    await self.bot.loop.run_in_executor(None, self.assets.forget, stale)
+                    await self.bot.loop.run_in_executor(None, self.assets.prune)
+                except OSError:
+                    self.bot.logger.exception("Failed to clean up the asset store.")
+
+        self.warm_task = self.bot.loop.create_task(warm())
+
+    async def prerender_loop(self):
+        await self.bot.wait_until_ready()
+
+        interval = self.bot.config.get("prerender_interval", 30)
+
+        while not self.bot.is_closed():
+            emoji = self.catalog.choose()
+
+            if emoji is not None:
+                # keep filling until the pool is full, then rotate one entry per interval
+                filter_index = random.randrange(len(images.FILTERS))
+
+                if (emoji.id, filter_index) not in self.renders:
+                    try:
+                        await self.render_emoji(emoji, filter_index)
+                    except (aiohttp.ClientError, OSError, asyncio.TimeoutError):
+                        self.bot.logger.warning(f"Failed to pre-render {emoji!r}, will retry later.")
+                    except BrokenExecutor:
+                        self.bot.logger.exception(f"An image worker died pre-rendering {emoji!r}, restarted them.")
+
+            await asyncio.sleep(interval if self.renders.full or emoji is None else 0.5)
+
+    async def schedule_loop(self):
+        interval = self.bot.config.get("schedule_interval", 5)
+
+        while not self.bot.is_closed():
+            try:
+                self.scheduler.tick(self.channels.values(), time.monotonic())
+            except Exception:
+                # keep going, or no channel would ever get another drop scheduled
+                self.bot.logger.exception("Failed to update the drop schedule.")
+
+            await asyncio.sleep(interval)
+
+    async def source_loop(self):
+        await self.bot.wait_until_ready()
+
+        interval = self.bot.config.get("emoji_refresh_interval", 600)
+
+        while not self.bot.is_closed():
+            # emoji changes in guilds held by other clusters never reach us, so poll for them
+            await asyncio.sleep(interval)
+            await self.load_remote_sources()
+
+    @commands.Cog.listener()
+    async def on_config_reload(self, old, new):
+        if frozenset(old.get("emoji_sources", ())) != frozenset(new.get("emoji_sources", ())):
+            await self.load_remote_sources()
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild, before, after):
+        if guild.id in self.emoji_sources:
+            await self.replace_source(guild.id, after)
 
-        immediate_time = time.monotonic()
-        if (message.content.lower().strip().replace(' ', '') in self.blob_options and
-                immediate_time < (self.last_drop + max_additional_delay)):
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild):
+        if guild.id in self.emoji_sources:
+            self.catalog.set_guild(guild.id, guild.emojis)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        if guild.id in self.emoji_sources:
+            # we can't see these any more, so stop dropping them; the asset store keeps them in case we're re-added
+            self.renders.invalidate(self.catalog.guilds.get(guild.id, set()))
+            self.catalog.remove_guild(guild.id)
 
-            if message.author.id not in self.additional_pickers:
-                self.additional_pickers.append(message.author.id)
-                self.bot.loop.create_task(self.add_coin(message.author, message.created_at))
-                self.bot.logger.info(f"User {message.author.id} additional-guessed blob ({self.last_coin_id}) in "
-                                     f"{immediate_time-self.last_drop:.3f} seconds.")
+    @commands.Cog.listener()
+    async def on_coin_totals(self, totals):
+        for user_id, coins in totals.items():
+            if coins is None:
+                self.balances.invalidate(user_id)
+                self.leaderboard.remove(user_id)
+            else:
+                self.balances.set(user_id, coins)
+                self.leaderboard.update(user_id, coins)
+
+    @commands.Cog.listener()
+    async def on_coin_totals_stale(self):
+        # balances changed in bulk (admin.py), or another shard changed them while we weren't listening
+        self.balances = balances.BalanceCache(self.balances.max_size)
+        self.leaderboard.cancel_load()
+
+    async def leaderboard_top(self, limit):
+        async with self.leaderboard_lock:
+            if self.leaderboard.needs_load(limit):
+                self.leaderboard.begin_load()
                 try:
-                    await message.delete()
-                except (discord.Forbidden, discord.HTTPException):
-                    pass
+                    async with self.bot.acquire() as conn:
+                        records = await conn.fetch(leaderboard.FETCH_TOP, self.leaderboard.capacity)
+                except Exception:
+                    self.leaderboard.cancel_load()
+                    raise
+
+                self.leaderboard.load(records)
+
+        return self.leaderboard.top(limit)
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        state = self.channels.get(message.channel.id)
+        if state is None:
+            return
 
+        state.messages += 1
+
+        drop = state.drop
+        if drop is not None and drop.could_match(message.content):
+            immediate_time = time.monotonic()
+
+            # anything the right length could be a guess, so it all counts, or the answer could be brute forced
+            if not self.guess_limiter.allow(message.author.id, immediate_time):
+                self.throttled_guesses.inc()
                 return
 
+            if drop.is_answer(message.content):
+                if drop.winner is None:
+                    self.pick_drop(state, drop, message, immediate_time)
+
+                if immediate_time < drop.bonus_until and message.author.id not in drop.pickers:
+                    drop.pickers.add(message.author.id)
+                    self.bot.loop.create_task(self.add_coin(message.author, message.created_at, kind="bonus",
+                                                            coin_id=drop.coin_id, channel_id=drop.channel_id,
+                                                            latency=immediate_time - drop.dropped_at))
+                    self.drop_events.inc(event="additional_pick")
+                    self.bot.logger.info(f"User {message.author.id} additional-guessed blob ({drop.coin_id}) in "
+                                         f"{immediate_time-drop.dropped_at:.3f} seconds.")
+                    self.outbox_for(message.channel).delete(message)
+                    return
+
         if self.no_drops:
             return
 
         if message.content.startswith("."):
             return  # do not drop coins on commands
 
-        if message.channel.id not in self.bot.config.get("drop_channels", []):
+        if state.phase != drops.IDLE or not self.bot.started.is_set():
             return
 
-        if self.drop_lock.locked():
-            return
+        if time.monotonic() >= state.next_drop:
+            coin_id = '%016x' % random.randrange(16**16)
+            self.bot.logger.info(f"A natural blob has dropped ({coin_id})")
+            await self.perform_natural_drop(state, message.channel, coin_id)
 
-        recovery = self.bot.config.get("recovery_time", 10)
-        drop_chance = self.bot.config.get("drop_chance", 0.1)
+    async def perform_natural_drop(self, state, channel, coin_id):
+        if state.phase != drops.IDLE:
+            return
 
-        exponential_element = min(max((time.monotonic() - self.wait_until) / recovery, 0), 1)
+        state.phase = drops.PREPARING
+        try:
+            await self.send_drop(state, channel, coin_id)
+        finally:
+            if state.phase == drops.PREPARING:
+                state.phase = drops.IDLE
+                # nothing went out, so don't try again on the very next message
+                self.scheduler.reschedule(state, time.monotonic())
 
-        weight = exponential_element ** 3
+    async def send_drop(self, state, channel, coin_id):
+        # one snapshot for the whole drop, so a reload halfway through can't mix old and new settings
+        config = self.bot.config
 
-        probability = weight * drop_chance
+        max_additional_delay = config.get("additional_delay", 10)
 
-        if random.random() < probability:
-            coin_id = '%016x' % random.randrange(16**16)
-            self.bot.logger.info(f"A natural blob has dropped ({coin_id})")
-            self.last_coin_id = coin_id
-            await self.perform_natural_drop(message.channel, coin_id)
+        cooldown = config.get("cooldown_time", 20)
 
-    async def perform_natural_drop(self, channel, coin_id):
-        async with self.drop_lock:
-            max_additional_delay = self.bot.config.get("additional_delay", 10)
+        if self.bot.coordinator is not None and not await self.bot.coordinator.claim_drop(channel.id, cooldown):
+            self.bot.logger.info(f"Another shard is already dropping in {channel.id}, skipping ({coin_id})")
+            return
 
-            cooldown = self.bot.config.get("cooldown_time", 20)
+        currency_name = config.get("currency", {})
+        singular_coin = currency_name.get("singular", "coins")
+        plural_coin = currency_name.get("plural", "coins")
 
-            currency_name = self.bot.config.get("currency", {})
-            singular_coin = currency_name.get("singular", "coins")
-            plural_coin = currency_name.get("plural", "coins")
+        drop_strings = config.get("drop_strings",
+                                  ["I found this blob, but I can't remember what it's called! What was it?"])
 
-            drop_strings = self.bot.config.get("drop_strings",
-                                               ["I found this blob, but I can't remember what it's called! What was it?"])
+        drop_string = random.choice(drop_strings)
 
-            drop_string = random.choice(drop_strings)
+        prepare_started = time.perf_counter()
 
-            # round up all emojis and pick one
-            guild_ids = self.bot.config.get("emoji_sources", [272885620769161216])
-            guilds = tuple(filter(None, map(self.bot.get_guild, guild_ids)))
-            emojis = tuple(filter(lambda x: not x.animated, itertools.chain(*[g.emojis for g in guilds])))
+        # take a pre-rendered blob if there is one, otherwise render one on the spot
+        emoji_chosen = None
+        picked = self.renders.pick()
 
-            if not emojis:
-                self.bot.logger.error(f"I wanted to drop a blob, but I couldn't find any suitable emoji!")
-                return
+        if picked is not None:
+            emoji_id, _, image_data = picked
+            emoji_chosen = self.catalog.get(emoji_id)
 
-            emoji_chosen = random.choice(emojis)
+            if emoji_chosen is None:
+                self.renders.invalidate({emoji_id})
 
-            self.last_blob = emoji_chosen
-            blob_options = [emoji_chosen.name, str(emoji_chosen)]
+        if emoji_chosen is None:
+            emoji_chosen = self.catalog.choose()
 
-            if len(emoji_chosen.name) > 4:  # don't cut off 'blob'
-                if emoji_chosen.name.startswith('blob'):  # allow omitting blob
-                    blob_options.append(emoji_chosen.name[4:])
-                elif emoji_chosen.name.endswith('blob'):
-                    blob_options.append(emoji_chosen.name[:-4])
-                elif emoji_chosen.name.startswith('google'):  # allow omitting google
-                    blob_options.append(emoji_chosen.name[6:])
+            if emoji_chosen is None:
+                self.bot.logger.error(f"I wanted to drop a blob, but I couldn't find any suitable emoji!")
+                return
 
-            self.blob_options = [x.lower().strip().replace(' ', '') for x in blob_options]
+            try:
+                image_data = await self.render_emoji(emoji_chosen, random.randrange(len(images.FILTERS)))
+            except asyncio.TimeoutError:
+                self.bot.logger.error(f"Rendering {emoji_chosen!r} took too long, giving up on this drop.")
+                return
+            except BrokenExecutor:
+                self.bot.logger.exception(f"An image worker died rendering {emoji_chosen!r}, giving up on this drop.")
+                return
+            except (aiohttp.ClientError, OSError):
+                self.bot.logger.exception(f"Failed to render {emoji_chosen!r}, giving up on this drop.")
+                return
+            self.drop_events.inc(event="render_miss")
 
-            # now let's go get it
-            async with self.bot.session.get(str(emoji_chosen.url)) as resp:
-                emoji_bytes = await resp.read()
+        self.phase_time.observe(time.perf_counter() - prepare_started, phase="prepare")
 
-            # perform a filter and get new file
-            file = await self.bot.loop.run_in_executor(None, self.do_filters, emoji_bytes)
+        file = discord.File(fp=BytesIO(image_data), filename="blob.png")
 
+        with self.phase_time.time(phase="send"), self.outbox_for(channel).priority():
             drop_message = await channel.send(drop_string, file=file)
 
-            self.additional_pickers = []
-            self.last_drop = time.monotonic()
-            self.wait_until = self.last_drop + cooldown
-            self.bot.loop.create_task(self.count_additional(channel, max_additional_delay))
+        self.drop_events.inc(event="drop")
 
-            try:
-                def pick_check(m):
-                    return m.channel.id == channel.id and m.content.lower() in self.blob_options
+        state.last_drop = time.monotonic()
+        state.wait_until = state.last_drop + cooldown
+        self.scheduler.reschedule(state, state.last_drop)
+        drop = state.drop = drops.DropState(coin_id, channel.id, emoji_chosen, state.last_drop,
+                                            max_additional_delay, singular_coin, plural_coin)
+        drop.message = drop_message
+        drop.lines.append(drop_string)
+        state.phase = drops.LIVE
 
-                drop_time = time.monotonic()
+        drop.expire_handle = self.bot.loop.call_later(config.get("pick_timeout", 90), self.expire_drop,
+                                                      state, drop)
+        self.bot.loop.call_later(max_additional_delay, self.count_additional, drop)
 
-                async with self.acquire_lock:
-                    pick_message = await self.bot.wait_for('message', check=pick_check, timeout=90)
+    def outbox_for(self, channel):
+        channel_outbox = self.outboxes.get(channel.id)
 
-                pick_time = time.monotonic()
-                self.bot.logger.info(f"User {pick_message.author.id} correctly guessed a blob ({coin_id}) in "
-                                     f"{pick_time-drop_time:.3f} seconds.")
-            except asyncio.TimeoutError:
-                await drop_message.delete()
-                return
-            else:
-                self.bot.loop.create_task(self.add_coin(pick_message.author, pick_message.created_at))
-                if time.monotonic() < (self.last_drop + max_additional_delay):
-                    await channel.send(f"{pick_message.author.mention} That's the one! Have 2 {plural_coin}!")
-                else:
-                    await channel.send(f"{pick_message.author.mention} That's the one! Have a {singular_coin}!")
-                await asyncio.sleep(max(self.last_drop + max_additional_delay - time.monotonic(), 0) + 1)
-                await drop_message.delete()
+        if channel_outbox is None:
+            channel_outbox = self.outboxes[channel.id] = outbox.ChannelOutbox(
+                self.bot, channel, self.bot.config.get("cleanup_delay", 1)
+            )
 
-    def do_filters(self, image_bytes: bytes) -> discord.File:
-        with Image.open(BytesIO(image_bytes)) as im:
-            filter_chosen = random.choice((
-                ImageFilter.GaussianBlur(radius=3),
-                ImageFilter.UnsharpMask(),
-                ImageFilter.ModeFilter(size=5),
-                ImageFilter.MinFilter(size=3)
-            ))
+        return channel_outbox
 
-            with im.convert('RGBA').filter(filter_chosen) as im2:
-                buffer = BytesIO()
-                im2.save(buffer, 'png')
+    def announce(self, drop, line):
+        """Adds a line to the drop message, along with any that were held back for it."""
+        drop.lines.append(line)
+        self.outbox_for(drop.message.channel).edit(drop.message, "\n".join(drop.lines))
 
-        buffer.seek(0)
-        return discord.File(fp=buffer, filename="blob.png")
+    def pick_drop(self, state, drop, message, pick_time):
+        drop.winner = message.author.id
+        drop.expire_handle.cancel()
+        state.phase = drops.PICKED
 
-    async def _add_coin(self, user_id, when):
-        await self.bot.db_available.wait()
+        self.phase_time.observe(pick_time - drop.dropped_at, phase="pick")
+        self.drop_events.inc(event="pick")
+        self.bot.logger.info(f"User {message.author.id} correctly guessed a blob ({drop.coin_id}) in "
+                             f"{pick_time-drop.dropped_at:.3f} seconds.")
 
-        async with self.bot.db.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetchval(
-                    """
-                    INSERT INTO currency_users (user_id, coins, last_picked)
-                    VALUES ($1, 1, $2)
-                    ON CONFLICT (user_id) DO UPDATE
-                    SET coins = currency_users.coins + 1, last_picked = $2
-                    RETURNING coins
-                    """,
-                    user_id,
-                    when
-                )
+        self.bot.loop.create_task(self.add_coin(message.author, message.created_at, coin_id=drop.coin_id,
+                                                channel_id=drop.channel_id, latency=pick_time - drop.dropped_at))
 
-    async def add_coin(self, member, when):
-        coins = str(await self._add_coin(member.id, when))
+        if pick_time < drop.bonus_until:
+            # goes out with the answer once the bonus window closes
+            drop.lines.append(f"{message.author.mention} That's the one! Have 2 {drop.plural_coin}!")
+        else:
+            self.announce(drop, f"{message.author.mention} That's the one! Have a {drop.singular_coin}!")
 
-        rewards = self.bot.config.get('reward_roles', {})
+        self.bot.loop.call_later(max(drop.bonus_until - pick_time, 0) + 1, self.settle_drop, state, drop)
 
-        if coins not in rewards:
-            return
+    def expire_drop(self, state, drop):
+        self.drop_events.inc(event="timeout")
+        self.settle_drop(state, drop)
 
-        role = member.guild.get_role(rewards[coins])
+    def settle_drop(self, state, drop):
+        if state.drop is drop:
+            state.drop = None
+            state.phase = drops.IDLE
 
-        if role is None:
-            self.bot.logger.warning(f'Failed to find reward role for {coins} coins.')
-            return
+        # a picked drop keeps its message, which has the answer on it by now
+        if drop.winner is None:
+            self.outbox_for(drop.message.channel).delete(drop.message)
 
-        try:
-            await member.add_roles(role, reason=f'Reached {coins} coins reward.')
-        except discord.HTTPException:
-            self.bot.logger.exception(f'Failed to add reward role for {coins} coins to {member!r}.')
+    async def _add_coin(self, user_id, when, **event):
+        return await self.bot.ledger.grant(user_id, when, **event)
 
-    async def count_additional(self, channel, wait_time):
-        await asyncio.sleep(wait_time)
+    async def add_coin(self, member, when, **event):
+        coins = await self._add_coin(member.id, when, **event)
 
-        async with self.acquire_lock:
-            picker_count = len(self.additional_pickers)
+        crossed = self.rewards.crossed(coins - event.get("amount", 1), coins)
+        if crossed:
+            self.role_grants.add(member, crossed)
 
-            if picker_count > 1:
-                await channel.send(f"(The correct blob was {self.last_blob}, "
+    def count_additional(self, drop):
+        picker_count = len(drop.pickers)
+
+        if picker_count > 1:
+            self.announce(drop, f"(The correct blob was {drop.emoji}, "
                                 f"{picker_count - 1} user(s) were fast enough to get a bonus coin)")
-            else:
-                await channel.send(f"(The correct blob was {self.last_blob})")
+        else:
+            self.announce(drop, f"(The correct blob was {drop.emoji})")
 
     @commands.cooldown(1, 4, commands.BucketType.user)
     @commands.cooldown(1, 1.5, commands.BucketType.channel)
@@ -233,19 +557,17 @@ class CoinDrop(commands.Cog):
         singular_coin = currency_name.get("singular", "coin")
         plural_coin = currency_name.get("plural", "coins")
 
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT coins FROM currency_users WHERE user_id = $1", ctx.author.id)
+        coins = await self.balances.get(self.bot, ctx.author.id)
 
-            try:
-                if record is None:
-                    await ctx.author.send(f"You haven't got any {plural_coin} yet!")
-                else:
-                    coins = record["coins"]
-                    coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
-                    await ctx.author.send(f"You have {coin_text}.")
-                await ctx.message.delete()
-            except (discord.Forbidden, discord.HTTPException):
-                pass
+        try:
+            if coins is None:
+                await ctx.author.send(f"You haven't got any {plural_coin} yet!")
+            else:
+                coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
+                await ctx.author.send(f"You have {coin_text}.")
+            await ctx.message.delete()
+        except (discord.Forbidden, discord.HTTPException):
+            pass
 
     @commands.has_permissions(ban_members=True)
     @commands.check(utils.check_granted_server)
@@ -259,15 +581,13 @@ class CoinDrop(commands.Cog):
         singular_coin = currency_name.get("singular", "coin")
         plural_coin = currency_name.get("plural", "coins")
 
-        async with self.bot.db.acquire() as conn:
-            record = await conn.fetchrow("SELECT coins FROM currency_users WHERE user_id = $1", target.id)
+        coins = await self.balances.get(self.bot, target.id)
 
-            if record is None:
-                await ctx.send(f"{target.mention} hasn't gotten any {plural_coin} yet!")
-            else:
-                coins = record["coins"]
-                coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
-                await ctx.send(f"{target.mention} has {coin_text}.")
+        if coins is None:
+            await ctx.send(f"{target.mention} hasn't gotten any {plural_coin} yet!")
+        else:
+            coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
+            await ctx.send(f"{target.mention} has {coin_text}.")
 
     @commands.cooldown(1, 4, commands.BucketType.user)
     @commands.cooldown(1, 1.5, commands.BucketType.channel)
@@ -286,21 +606,41 @@ class CoinDrop(commands.Cog):
         if mode == 'long' and (not ctx.guild or ctx.author.guild_permissions.ban_members):
             limit = 25
 
-        async with self.bot.db.acquire() as conn:
-            records = await conn.fetch("""
-            SELECT * FROM currency_users
-            ORDER BY coins DESC
-            LIMIT $1
-            """, limit)
-
-            listing = []
-            for index, record in enumerate(records):
-                coins = record["coins"]
-                coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
-                listing.append(f"{index+1}: <@{record['user_id']}> with {coin_text}")
+        listing = []
+        for index, (user_id, coins) in enumerate(await self.leaderboard_top(limit)):
+            coin_text = f"{coins} {singular_coin if coins==1 else plural_coin}"
+            listing.append(f"{index+1}: <@{user_id}> with {coin_text}")
 
         await ctx.send(embed=discord.Embed(description="\n".join(listing), color=0xff0000))
 
+    @commands.cooldown(1, 4, commands.BucketType.user)
+    @commands.cooldown(1, 1.5, commands.BucketType.channel)
+    @commands.command("rank")
+    async def rank_command(self, ctx: commands.Context, *, target: discord.Member = None):
+        """Check your position on the leaderboard"""
+        if not self.bot.db_available.is_set():
+            return
+
+        target = target or ctx.author
+
+        currency_name = self.bot.config.get("currency", {})
+        plural_coin = currency_name.get("plural", "coins")
+
+        coins = await self.balances.get(self.bot, target.id)
+
+        if coins is None:
+            await ctx.send(f"{target.mention} hasn't gotten any {plural_coin} yet!")
+            return
+
+        position = self.leaderboard.rank(target.id)
+
+        if position is None:
+            # below the in-memory board, so count who's ahead using the coins index
+            async with self.bot.acquire() as conn:
+                position = await conn.fetchval(leaderboard.COUNT_AHEAD, coins) + 1
+
+        await ctx.send(f"{target.mention} is #{position} on the leaderboard.")
+
     @commands.has_permissions(ban_members=True)
     @commands.check(utils.check_granted_server)
     @commands.command("reset_user")
@@ -310,34 +650,281 @@ class CoinDrop(commands.Cog):
             await ctx.send("No connection to database.")
             return
 
-        async with self.bot.db.acquire() as conn:
+        # buffered grants would otherwise be written after the reset and bring the account back
+        await self.bot.ledger.flush()
+
+        async with self.bot.acquire() as conn:
             record = await conn.fetchrow("SELECT * FROM currency_users WHERE user_id = $1", user.id)
             if record is None:
                 await ctx.send("This user doesn't have a database entry.")
                 return
 
-            confirm_text = f"confirm {random.randint(0, 999999):06}"
+            if not await self.confirm(ctx, f"Are you sure? This user has {record['coins']} coins, last picking one "
+                                           f"up at {record['last_picked']} UTC."):
+                return
+
+            await self.bot.ledger.flush()
+            await conn.execute(events.RESET_USER, user.id)
+
+            self.balances.invalidate(user.id)
+            self.leaderboard.remove(user.id)
+
+            if self.bot.coordinator is not None:
+                await self.bot.coordinator.publish(conn, {user.id: None})
+
+            await ctx.send(f"Cleared entry for {user.id}")
+
+    async def confirm(self, ctx: commands.Context, question: str) -> bool:
+        confirm_text = f"confirm {random.randint(0, 999999):06}"
+
+        await ctx.send(f"{question} (type '{confirm_text}' or 'cancel')")
 
-            await ctx.send(f"Are you sure? This user has {record['coins']} coins, last picking one up at "
-                           f"{record['last_picked']} UTC. (type '{confirm_text}' or 'cancel')")
+        def wait_check(msg):
+            return msg.author.id == ctx.author.id and msg.content.lower() in (confirm_text, "cancel")
 
-            def wait_check(msg):
-                return msg.author.id == ctx.author.id and msg.content.lower() in (confirm_text, "cancel")
+        try:
+            validate_message = await self.bot.wait_for('message', check=wait_check, timeout=30)
+        except asyncio.TimeoutError:
+            await ctx.send("Timed out, nothing was changed.")
+            return False
+
+        if validate_message.content.lower() == 'cancel':
+            await ctx.send("Cancelled.")
+            return False
+
+        return True
+
+    async def balances_changed(self, conn):
+        """Forgets every cached balance, here and on the other shards, after a change to many accounts."""
+        self.balances = balances.BalanceCache(self.balances.max_size)
+        self.leaderboard.cancel_load()
+
+        if self.bot.coordinator is not None:
+            await self.bot.coordinator.publish_stale(conn)
+
+    @commands.is_owner()
+    @commands.command("reload_config")
+    async def reload_config(self, ctx: commands.Context):
+        """Reload the config file without restarting"""
+        if self.bot.config_path is None:
+            await ctx.send("There's no config file to reload from.")
+            return
+
+        try:
+            changed = self.bot.reload_config()
+        except (OSError, ConfigError) as error:
+            await ctx.send(f"Couldn't reload the config, keeping the current one: {error}")
+            return
+
+        needs_restart = [key for key in changed if key in RESTART_REQUIRED]
+        message = f"Reloaded config, changed: {', '.join(changed) or 'nothing'}."
+        if needs_restart:
+            message += f" {', '.join(needs_restart)} only take effect after a restart."
+
+        await ctx.send(message)
+
+    @commands.is_owner()
+    @commands.command("rebuild_balances")
+    async def rebuild_balances(self, ctx: commands.Context):
+        """Recalculate every balance from the coin event log"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        await self.bot.ledger.flush()
+
+        async with self.bot.acquire() as conn:
+            accounts = await events.rebuild_balances(conn)
+            await self.balances_changed(conn)
+
+        await ctx.send(f"Rebuilt balances for {accounts} users.")
+
+    async def bulk_change(self, ctx: commands.Context, targets, change, description: str):
+        try:
+            selection = admin.Selection.parse(targets)
+        except ValueError as error:
+            await ctx.send(str(error))
+            return
+
+        if not selection:
+            await ctx.send("Give some users or filters, use coins>=0 to mean everyone.")
+            return
+
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        async with self.bot.acquire() as conn:
+            accounts, coins = await admin.count_users(conn, selection)
+
+        if not accounts:
+            await ctx.send(f"No accounts match {selection}.")
+            return
 
+        if not await self.confirm(ctx, f"This will {description} {accounts} account(s) ({selection}) holding "
+                                       f"{coins} coins between them. Are you sure?"):
+            return
+
+        await self.bot.ledger.flush()
+        async with self.bot.acquire() as conn:
+            accounts, coins = await change(conn, selection)
+            await self.balances_changed(conn)
+
+        self.bot.logger.info(f"{ctx.author.id} changed {accounts} account(s) ({selection}) by {coins} coins")
+        await ctx.send(f"Changed {accounts} account(s) by {coins:+} coins in total.")
+
+    @commands.is_owner()
+    @commands.command("bulk_reset")
+    async def bulk_reset(self, ctx: commands.Context, *targets: str):
+        """Reset every matching account, e.g. coins<10 last_picked<2020-01-01 or user ids"""
+        await self.bulk_change(ctx, targets, admin.reset_users, "reset")
+
+    @commands.is_owner()
+    @commands.command("bulk_adjust")
+    async def bulk_adjust(self, ctx: commands.Context, amount: int, *targets: str):
+        """Add (or with a negative amount, take) coins from every matching account"""
+        await self.bulk_change(ctx, targets, lambda conn, selection: admin.adjust_users(conn, selection, amount),
+                               f"add {amount} coins to" if amount >= 0 else f"take {-amount} coins from")
+
+    @commands.is_owner()
+    @commands.command("export_users")
+    async def export_users(self, ctx: commands.Context, file_format: str = "csv", *targets: str):
+        """Export matching accounts (or everyone) to a csv or jsonl file"""
+        if file_format not in admin.FORMATS:
+            await ctx.send(f"Format must be one of {', '.join(admin.FORMATS)}.")
+            return
+
+        try:
+            selection = admin.Selection.parse(targets)
+        except ValueError as error:
+            await ctx.send(str(error))
+            return
+
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        export_path = self.bot.config.get("export_path", "exports")
+        os.makedirs(export_path, exist_ok=True)
+        path = os.path.join(export_path, f"currency_users-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}.{file_format}")
+
+        await self.bot.ledger.flush()
+        async with self.bot.acquire() as conn:
+            written = await admin.export_users(conn, path, selection)
+
+        limit = ctx.guild.filesize_limit if ctx.guild is not None else 8 * 1024 * 1024
+        if os.path.getsize(path) > limit:
+            await ctx.send(f"Exported {written} account(s) to {path}, too big to upload here.")
+        else:
+            await ctx.send(f"Exported {written} account(s).", file=discord.File(path))
+
+    @commands.is_owner()
+    @commands.command("import_users")
+    async def import_users(self, ctx: commands.Context, mode: str = "set"):
+        """Import accounts from an attached csv or jsonl export, replacing balances (set) or adding to them (add)"""
+        if mode not in admin.IMPORT_COINS:
+            await ctx.send(f"Mode must be one of {', '.join(admin.IMPORT_COINS)}.")
+            return
+
+        if not ctx.message.attachments:
+            await ctx.send("Attach a .csv or .jsonl file to import.")
+            return
+
+        attachment = ctx.message.attachments[0]
+        try:
+            admin.export_format(attachment.filename)
+        except ValueError as error:
+            await ctx.send(str(error))
+            return
+
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        if not await self.confirm(ctx, f"This will {'add' if mode == 'add' else 'set'} the balances in "
+                                       f"{attachment.filename}. Are you sure?"):
+            return
+
+        export_path = self.bot.config.get("export_path", "exports")
+        os.makedirs(export_path, exist_ok=True)
+        path = os.path.join(export_path, f"import-{attachment.id}-{os.path.basename(attachment.filename)}")
+        await attachment.save(path)
+
+        await self.bot.ledger.flush()
+        async with self.bot.acquire() as conn:
             try:
-                validate_message = await self.bot.wait_for('message', check=wait_check, timeout=30)
-            except asyncio.TimeoutError:
-                await ctx.send(f"Timed out request to reset {user.id}.")
+                accounts, coins = await admin.import_users(conn, path, mode)
+            except (ValueError, asyncpg.DataError) as error:
+                await ctx.send(f"Couldn't import {attachment.filename}, nothing was changed: {error}")
                 return
-            else:
-                if validate_message.content.lower() == 'cancel':
-                    await ctx.send("Cancelled.")
-                    return
 
-                async with conn.transaction():
-                    await conn.execute("DELETE FROM currency_users WHERE user_id = $1", user.id)
+            await self.balances_changed(conn)
+
+        self.bot.logger.info(f"{ctx.author.id} imported {accounts} account(s) from {path} ({mode})")
+        await ctx.send(f"Imported {accounts} account(s), changing balances by {coins:+} coins in total.")
+
+    @commands.is_owner()
+    @commands.command("sync_roles")
+    async def sync_roles(self, ctx: commands.Context):
+        """Give reward roles to everyone who has earned one but is missing it"""
+        if not self.bot.db_available.is_set():
+            await ctx.send("No connection to database.")
+            return
+
+        if not self.rewards:
+            await ctx.send("There are no reward roles set up.")
+            return
+
+        if self.role_sync_lock.locked():
+            await ctx.send("Already syncing reward roles.")
+            return
+
+        async with self.role_sync_lock:
+            await ctx.send("Syncing reward roles, this may take a while.")
+            added, members, missing = await self.backfill_roles()
+
+        await ctx.send(f"Added {added} role(s) to {members} member(s). "
+                       f"{missing} user(s) with rewards weren't found in any server.")
 
-                await ctx.send(f"Cleared entry for {user.id}")
+    async def backfill_roles(self):
+        role_ids = self.rewards.role_ids
+        guilds = [guild for guild in self.bot.guilds if any(guild.get_role(role_id) for role_id in role_ids)]
+
+        page_size = self.bot.config.get("role_sync_page_size", 500)
+        pause = self.bot.config.get("role_sync_interval", 1)
+
+        added = members = missing = 0
+        last_user = 0
+
+        while True:
+            async with self.bot.acquire() as conn:
+                page = await conn.fetch(rewards.FETCH_EARNERS, self.rewards.lowest, last_user, page_size)
+
+            for record in page:
+                earned = self.rewards.earned(record["coins"])
+                found = False
+
+                for guild in guilds:
+                    member = guild.get_member(record["user_id"])
+                    if member is None:
+                        continue
+
+                    found = True
+                    count = await rewards.add_reward_roles(self.bot, member, {
+                        role_id: threshold for threshold, role_id in earned if guild.get_role(role_id) is not None
+                    })
+                    if count:
+                        added += count
+                        members += 1
+                        # one call at a time, spaced out, so a big backfill doesn't eat the rate limits
+                        await asyncio.sleep(pause)
+
+                missing += not found
+
+            if len(page) < page_size:
+                return added, members, missing
+
+            last_user = page[-1]["user_id"]
 
     @commands.has_permissions(ban_members=True)
     @commands.check(utils.check_granted_server)
@@ -371,19 +958,20 @@ class CoinDrop(commands.Cog):
             await ctx.send("Cannot access the db right now.")
             return
 
-        if self.drop_lock.locked():
-            await ctx.send("A coin is already spawned somewhere.")
-            return
+        state = self.channels.get(where.id)
 
-        if where.id not in self.bot.config.get("drop_channels", []):
+        if state is None:
             await ctx.send("Channel is not in drop list.")
             return
 
+        if state.phase != drops.IDLE:
+            await ctx.send("A coin is already spawned in that channel.")
+            return
+
         coin_id = '%016x' % random.randrange(16 ** 16)
         self.bot.logger.info(f"A random coin was force dropped by {ctx.author.id} ({coin_id})")
-        self.last_coin_id = coin_id
         self.bot.loop.create_task(self.attempt_add_reaction(ctx.message, "\N{WHITE HEAVY CHECK MARK}"))
-        await self.perform_natural_drop(where, coin_id)
+        await self.perform_natural_drop(state, where, coin_id)
 
 
 def setup(bot):
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import math
+import time
+
+
+# what a drop channel is doing; see DropChannel
+IDLE = "idle"
+PREPARING = "preparing"
+LIVE = "live"
+PICKED = "picked"
+
+
+def normalize(text: str) -> str:
+    return text.lower().strip().replace(' ', '')
+
+
+def answers_for(emoji) -> frozenset:
+    options = [emoji.name, str(emoji)]
+
+    if len(emoji.name) > 4:  # don't cut off 'blob'
+        if emoji.name.startswith('blob'):  # allow omitting blob
+            options.append(emoji.name[4:])
+        elif emoji.name.endswith('blob'):
+            options.append(emoji.name[:-4])
+        elif emoji.name.startswith('google'):  # allow omitting google
+            options.append(emoji.name[6:])
+
+    return frozenset(map(normalize, options))
+
+
+class DropState:
+    """A drop that is currently out, with everything the message path needs resolved up front.
+
+    ``emoji`` is the :class:`~cogs.catalog.CatalogEntry` that was dropped.
+    """
+
+    __slots__ = ("coin_id", "channel_id", "emoji", "answers", "min_length", "max_length", "dropped_at",
+                 "bonus_until", "pickers", "singular_coin", "plural_coin", "message", "lines", "winner",
+                 "expire_handle")
+
+    def __init__(self, coin_id: str, channel_id: int, emoji, dropped_at: float, additional_delay: float,
+                 singular_coin: str, plural_coin: str):
+        self.coin_id = coin_id
+        self.channel_id = channel_id
+        self.emoji = emoji
+        self.answers = emoji.answers
+        # discord trims messages already, so normalizing one only ever takes out its spaces
+        self.min_length = min(map(len, self.answers))
+        self.max_length = max(map(len, self.answers))
+        self.dropped_at = dropped_at
+        self.bonus_until = dropped_at + additional_delay
+        self.pickers = set()
+        self.singular_coin = singular_coin
+        self.plural_coin = plural_coin
+        self.message = None
+        self.lines = []  # what the drop message says, announcements included
+        self.winner = None
+        self.expire_handle = None
+
+    def could_match(self, content: str) -> bool:
+        """Cheap length check that rules out most chat before it's normalized."""
+        length = len(content)
+        if length < self.min_length:
+            return False
+
+        return self.min_length <= length - content.count(' ') <= self.max_length
+
+    def is_answer(self, content: str) -> bool:
+        return normalize(content) in self.answers
+
+    def matches(self, content: str) -> bool:
+        return self.could_match(content) and self.is_answer(content)
+
+
+class DropChannel:
+    """Drop scheduling state for a single drop channel.
+
+    ``phase`` goes from ``IDLE`` to ``PREPARING`` while a drop is rendered and sent, to
+    ``LIVE`` once it's out, to ``PICKED`` once someone got it, and back to ``IDLE`` when its
+    message is cleaned up. Only an idle channel can drop.
+    """
+
+    __slots__ = ("channel_id", "phase", "last_drop", "wait_until", "drop", "messages", "message_rate",
+                 "rate_updated", "next_drop")
+
+    def __init__(self, channel_id: int):
+        self.channel_id = channel_id
+        self.phase = IDLE
+        self.last_drop = time.monotonic()
+        self.wait_until = self.last_drop
+        self.drop = None
+        # kept by the DropScheduler
+        self.messages = 0
+        self.message_rate = 0.0
+        self.rate_updated = self.last_drop
+        self.next_drop = math.inf
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import multiprocessing
+import random
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+
+# names in PIL.ImageFilter, so Pillow isn't imported until something is actually rendered
+FILTERS = (
+    ("GaussianBlur", {"radius": 3}),
+    ("UnsharpMask", {}),
+    ("ModeFilter", {"size": 5}),
+    ("MinFilter", {"size": 3}),
+)
+
+
+# decoded emojis kept by each worker process, so repeat renders of an emoji skip decoding it
+WORKER_CACHE_SIZE = 32
+_decoded = OrderedDict()
+
+
+def _apply_filter(im, filter_index: int) -> bytes:
+    from PIL import ImageFilter
+
+    filter_name, kwargs = FILTERS[filter_index]
+
+    with im.filter(getattr(ImageFilter, filter_name)(**kwargs)) as im2:
+        buffer = BytesIO()
+        im2.save(buffer, 'png')
+
+    return buffer.getvalue()
+
+
+def do_filters(image_bytes: bytes, filter_index: int) -> bytes:
+    from PIL import Image
+
+    with Image.open(BytesIO(image_bytes)) as im:
+        with im.convert('RGBA') as converted:
+            return _apply_filter(converted, filter_index)
+
+
+def filter_worker(key, image_bytes: bytes, filter_index: int) -> bytes:
+    """Like :func:`do_filters`, but caches the decoded image. Only safe in single-threaded workers."""
+    im = _decoded.get(key)
+
+    if im is None:
+        from PIL import Image
+
+        with Image.open(BytesIO(image_bytes)) as source:
+            im = _decoded[key] = source.convert('RGBA')
+
+        while len(_decoded) > WORKER_CACHE_SIZE:
+            _decoded.popitem(last=False)[1].close()
+    else:
+        _decoded.move_to_end(key)
+
+    return _apply_filter(im, filter_index)
+
+
+class ImageEngine:
+    """Runs image filters on a dedicated, bounded executor.
+
+    ``mode`` is ``"thread"`` or ``"process"``; processes keep Pillow work off the GIL that
+    discord.py and asyncpg share, and each keeps a small cache of decoded emojis. At most
+    ``max_pending`` renders are queued at once, and a render that isn't done within
+    ``timeout`` seconds (queueing included) raises :exc:`asyncio.TimeoutError`.
+    """
+
+    def __init__(self, mode: str = "thread", workers: int = 2, max_pending: int = 4, timeout: float = 10):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown image engine mode {mode!r}")
+
+        self.mode = mode
+        self.workers = workers
+        self.timeout = timeout
+        self.slots = asyncio.Semaphore(max_pending)
+        self.executor = self._create_executor()
+
+    def _create_executor(self):
+        if self.mode == "process":
+            return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return ThreadPoolExecutor(self.workers, thread_name_prefix="coindrop-images")
+
+    def _replace_executor(self, broken):
+        # several renders can fail on the same broken pool, only the first one replaces it
+        if self.executor is broken:
+            self.executor = self._create_executor()
+            broken.shutdown(wait=False)
+
+    async def render(self, key, image_bytes, filter_index: int) -> bytes:
+        """Filters an image. ``key`` identifies the source image for the worker-side cache.
+
+        Raises :exc:`~concurrent.futures.BrokenExecutor` if a worker died, after starting a new executor
+        for the renders that follow.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.timeout
+
+        await asyncio.wait_for(self.slots.acquire(), self.timeout)
+
+        executor = self.executor
+        try:
+            if self.mode == "process":
+                future = loop.run_in_executor(executor, filter_worker, key, bytes(image_bytes), filter_index)
+            else:
+                future = loop.run_in_executor(executor, do_filters, image_bytes, filter_index)
+        except BrokenExecutor:
+            self.slots.release()
+            self._replace_executor(executor)
+            raise
+
+        # a render that times out keeps its worker busy, so its slot is only freed once it's actually done
+        future.add_done_callback(self._finished)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), max(deadline - loop.time(), 0))
+        except BrokenExecutor:
+            self._replace_executor(executor)
+            raise
+
+    def _finished(self, future):
+        self.slots.release()
+
+        if not future.cancelled():
+            future.exception()  # nobody is waiting on a render that timed out, so don't warn about its error
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class RenderCache:
+    """Bounded LRU pool of filtered PNGs, keyed by (emoji id, filter index)."""
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def full(self):
+        return len(self.entries) >= self.max_size
+
+    def put(self, emoji_id: int, filter_index: int, data: bytes):
+        key = (emoji_id, filter_index)
+        self.entries[key] = data
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def pick(self):
+        """Returns a random (emoji id, filter index, data) entry, or None if nothing is rendered yet."""
+        if not self.entries:
+            return None
+
+        key = random.choice(tuple(self.entries))
+        self.entries.move_to_end(key)
+        return (*key, self.entries[key])
+
+    def invalidate(self, emoji_ids):
+        for key in [key for key in self.entries if key[0] in emoji_ids]:
+            del self.entries[key]
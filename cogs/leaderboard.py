@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+
+
+FETCH_TOP = """
+SELECT user_id, coins FROM currency_users
+ORDER BY coins DESC, user_id
+LIMIT $1
+"""
+
+COUNT_AHEAD = "SELECT COUNT(*) FROM currency_users WHERE coins > $1"
+
+
+class Leaderboard:
+    """The highest balances, kept sorted in memory.
+
+    ``entries`` is always exactly the top ``len(entries)`` rows of currency_users (ordered
+    like ``FETCH_TOP``), or the whole table when ``complete`` is set. Grants keep it current;
+    removals and decreases only ever shrink it, and :meth:`needs_load` says when it has
+    shrunk too far to answer from.
+    """
+
+    def __init__(self, capacity: int = 50):
+        self.capacity = capacity
+        self.entries = []  # (-coins, user_id), ascending
+        self.coins = {}
+        self.complete = False
+        self.replay = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def needs_load(self, limit: int) -> bool:
+        return not self.complete and len(self.entries) < limit
+
+    def begin_load(self):
+        # changes that land while the top is being fetched are applied after it
+        self.replay = {}
+
+    def load(self, records):
+        self.entries = sorted((-record["coins"], record["user_id"]) for record in records)
+        self.coins = {user_id: -negative_coins for negative_coins, user_id in self.entries}
+        self.complete = len(self.entries) < self.capacity
+
+        replay, self.replay = self.replay or {}, None
+        for user_id, coins in replay.items():
+            if coins is None:
+                self.remove(user_id)
+            else:
+                self.update(user_id, coins)
+
+    def cancel_load(self):
+        self.replay = None
+        self.entries = []
+        self.coins = {}
+        self.complete = False
+
+    def _discard(self, user_id: int):
+        coins = self.coins.pop(user_id, None)
+        if coins is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-coins, user_id))]
+        return coins
+
+    def _fits(self, key) -> bool:
+        return self.complete or (self.entries and key < self.entries[-1])
+
+    def update(self, user_id: int, coins: int):
+        if self.replay is not None:
+            self.replay[user_id] = coins
+            return
+
+        key = (-coins, user_id)
+        old = self._discard(user_id)
+
+        # an increase can't let anyone untracked past us, but a decrease might
+        if (old is not None and coins >= old) or self._fits(key):
+            bisect.insort(self.entries, key)
+            self.coins[user_id] = coins
+
+            if len(self.entries) > self.capacity:
+                _, dropped = self.entries.pop()
+                del self.coins[dropped]
+                self.complete = False
+
+    def remove(self, user_id: int):
+        if self.replay is not None:
+            self.replay[user_id] = None
+            return
+
+        self._discard(user_id)
+
+    def top(self, limit: int):
+        return [(user_id, -negative_coins) for negative_coins, user_id in self.entries[:limit]]
+
+    def rank(self, user_id: int):
+        """Returns the user's competition rank, or None if they aren't on the board."""
+        coins = self.coins.get(user_id)
+        if coins is None:
+            return None
+
+        return bisect.bisect_left(self.entries, (-coins,)) + 1
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from contextlib import contextmanager
+
+import discord
+
+
+# discord won't bulk delete more than this at once
+BULK_DELETE_LIMIT = 100
+
+
+class ChannelOutbox:
+    """Cleanup traffic for one channel: message deletes and edits, coalesced.
+
+    Deletes are collected for ``delay`` seconds and sent as bulk deletes, and edits of the
+    same message that haven't gone out yet are merged so only the newest content is sent. Calls go out one at a time,
+    and none start while a drop is being sent (see :meth:`priority`), so drops never queue
+    behind cleanup in the rate limits.
+    """
+
+    def __init__(self, bot, channel, delay: float = 1.0):
+        self.bot = bot
+        self.channel = channel
+        self.delay = delay
+        self.deletes = []
+        self.edits = {}  # message: content
+        self.clear = asyncio.Event()
+        self.clear.set()
+        self.sending = 0
+        self.flush_task = None
+
+    def delete(self, message):
+        self.deletes.append(message)
+        self.schedule()
+
+    def edit(self, message, content: str):
+        self.edits[message] = content
+        self.schedule()
+
+    def schedule(self):
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = self.bot.loop.create_task(self.flush())
+
+    @contextmanager
+    def priority(self):
+        """Holds back cleanup for as long as the block runs."""
+        self.sending += 1
+        self.clear.clear()
+        try:
+            yield
+        finally:
+            self.sending -= 1
+            if not self.sending:
+                self.clear.set()
+
+    async def flush(self):
+        # edits already carry everything they were waiting on, so only deletes wait to be batched
+        if not self.edits:
+            await asyncio.sleep(self.delay)
+
+        while self.edits or self.deletes:
+            await self.clear.wait()
+
+            # edits are what people are waiting to see, so they go first
+            if self.edits:
+                message = next(iter(self.edits))
+                content = self.edits.pop(message)
+                await self.attempt(message.edit(content=content))
+                continue
+
+            batch = self.deletes[:BULK_DELETE_LIMIT]
+            del self.deletes[:BULK_DELETE_LIMIT]
+
+            try:
+                await self.channel.delete_messages(batch)
+            except discord.Forbidden:
+                # bulk deletes need Manage Messages, but the bot can always delete its own messages one by one
+                for message in batch:
+                    if message.author.id == self.bot.user.id:
+                        await self.attempt(message.delete())
+            except discord.HTTPException:
+                self.bot.logger.warning(f"Cleanup in channel {self.channel.id} failed, skipping it.")
+
+    async def attempt(self, call):
+        try:
+            await call
+        except discord.HTTPException:
+            self.bot.logger.warning(f"Cleanup in channel {self.channel.id} failed, skipping it.")
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import bisect
+
+import discord
+
+
+# users who can have earned a reward, a page at a time in user id order
+FETCH_EARNERS = """
+SELECT user_id, coins FROM currency_users
+WHERE coins >= $1 AND user_id > $2
+ORDER BY user_id
+LIMIT $3
+"""
+
+
+class RewardThresholds:
+    """The ``reward_roles`` config, sorted by threshold so lookups are a bisect."""
+
+    def __init__(self, reward_roles: dict):
+        ordered = sorted((int(coins), role_id) for coins, role_id in reward_roles.items())
+        self.thresholds = [coins for coins, _ in ordered]
+        self.roles = [role_id for _, role_id in ordered]
+
+    def __bool__(self):
+        return bool(self.thresholds)
+
+    @property
+    def role_ids(self):
+        return set(self.roles)
+
+    @property
+    def lowest(self):
+        return self.thresholds[0] if self.thresholds else None
+
+    def crossed(self, old: int, new: int):
+        """Returns the (threshold, role id) pairs reached by going from ``old`` to ``new`` coins."""
+        start = bisect.bisect_right(self.thresholds, old)
+        end = bisect.bisect_right(self.thresholds, new)
+        return list(zip(self.thresholds[start:end], self.roles[start:end]))
+
+    def earned(self, coins: int):
+        """Returns the (threshold, role id) pairs for every reward at or below ``coins``."""
+        end = bisect.bisect_right(self.thresholds, coins)
+        return list(zip(self.thresholds[:end], self.roles[:end]))
+
+
+class RoleGrants:
+    """Adds reward roles, merging everything a member earned in the same moment into one call."""
+
+    def __init__(self, bot, delay: float = 0.5):
+        self.bot = bot
+        self.delay = delay
+        self.pending = {}  # (guild id, member id): [member, {role id: threshold}]
+        self.flush_task = None
+
+    def add(self, member, rewards):
+        entry = self.pending.get((member.guild.id, member.id))
+        if entry is None:
+            entry = self.pending[(member.guild.id, member.id)] = [member, {}]
+
+        entry[1].update((role_id, threshold) for threshold, role_id in rewards)
+
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = self.bot.loop.create_task(self.flush())
+
+    async def flush(self):
+        await asyncio.sleep(self.delay)
+
+        # grants that come in while roles are being added are picked up by the next pass
+        while self.pending:
+            batch, self.pending = self.pending, {}
+
+            for member, rewards in batch.values():
+                await add_reward_roles(self.bot, member, rewards)
+
+
+async def add_reward_roles(bot, member, rewards: dict) -> int:
+    """Adds the roles in ``rewards`` (role id: threshold) that ``member`` is missing. Returns how many were added."""
+    roles = []
+
+    for role_id, threshold in rewards.items():
+        role = member.guild.get_role(role_id)
+
+        if role is None:
+            bot.logger.warning(f'Failed to find reward role for {threshold} coins.')
+        elif role not in member.roles:
+            roles.append(role)
+
+    if not roles:
+        return 0
+
+    highest = max(rewards.values())
+    try:
+        await member.add_roles(*roles, reason=f'Reached {highest} coins reward.')
+    except discord.HTTPException:
+        bot.logger.exception(f'Failed to add reward role for {highest} coins to {member!r}.')
+        return 0
+
+    return len(roles)
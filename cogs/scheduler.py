@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+import math
+import random
+
+
+class DropScheduler:
+    """Decides when each drop channel drops next.
+
+    Message counts are folded into a per-channel message rate (an exponentially weighted
+    average with a ``half_life`` in seconds) on every :meth:`tick`. A channel sending at least
+    ``active_rate`` messages a minute gets ``drops_per_hour`` outside of its cooldowns, quieter
+    ones proportionally fewer, and the next drop is drawn from that ahead of time and stored
+    in the channel's ``next_drop``. A drop goes out with the first message at or after that
+    instant, so the message path only compares timestamps.
+
+    Everything takes ``now`` from the caller, so it can run on recorded traffic with
+    :func:`simulate`.
+    """
+
+    def __init__(self, drops_per_hour: float = 30, active_rate: float = 10, half_life: float = 60,
+                 rng: random.Random = None):
+        self.drops_per_second = drops_per_hour / 3600
+        self.active_rate = active_rate / 60
+        self.half_life = half_life
+        self.rng = rng or random.Random()
+
+    def drop_rate(self, state) -> float:
+        return self.drops_per_second * min(state.message_rate / self.active_rate, 1)
+
+    def reschedule(self, state, now: float):
+        """Draws ``state.next_drop``, counting from the end of the channel's cooldown."""
+        rate = self.drop_rate(state)
+
+        if rate <= 0:
+            state.next_drop = math.inf
+        else:
+            state.next_drop = max(now, state.wait_until) + self.rng.expovariate(rate)
+
+    def tick(self, states, now: float):
+        for state in states:
+            elapsed = now - state.rate_updated
+            if elapsed <= 0:
+                continue
+
+            decay = 0.5 ** (elapsed / self.half_life)
+            state.message_rate = state.message_rate * decay + state.messages / elapsed * (1 - decay)
+            state.messages = 0
+            state.rate_updated = now
+
+            # waiting times are memoryless, so drawing again at the new rate keeps drops evenly spread;
+            # one that's already due stays due until a message comes along for it
+            if state.next_drop > now:
+                self.reschedule(state, now)
+
+
+def simulate(scheduler: DropScheduler, timestamps, cooldown: float = 20, tick: float = 5):
+    """Replays message ``timestamps`` (seconds, sorted) through ``scheduler`` for one channel.
+
+    Returns the times drops would have gone out at.
+    """
+    from .drops import DropChannel
+
+    if not timestamps:
+        return []
+
+    state = DropChannel(0)
+    state.last_drop = state.wait_until = state.rate_updated = next_tick = timestamps[0]
+    dropped = []
+
+    for now in timestamps:
+        while next_tick <= now:
+            scheduler.tick((state,), next_tick)
+            next_tick += tick
+
+        state.messages += 1
+
+        if now >= state.next_drop:
+            dropped.append(now)
+            state.last_drop = now
+            state.wait_until = now + cooldown
+            scheduler.reschedule(state, now)
+
+    return dropped
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+
+class GuessLimiter:
+    """Per-user token buckets for guesses.
+
+    Every user can make ``burst`` guesses at once, refilled at ``rate`` guesses a second.
+    Buckets that would be full again are dropped every so often, so only users who guessed
+    recently take up memory.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: float = 3.0):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # user id: (tokens, monotonic time they were counted)
+        self.idle_time = burst / rate
+        self.next_sweep = 0.0
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, user_id: int, now: float) -> bool:
+        if now >= self.next_sweep:
+            self.sweep(now)
+
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            tokens = self.burst
+        else:
+            tokens = min(bucket[0] + (now - bucket[1]) * self.rate, self.burst)
+
+        if tokens < 1:
+            return False
+
+        self.buckets[user_id] = (tokens - 1, now)
+        return True
+
+    def sweep(self, now: float):
+        cutoff = now - self.idle_time
+        self.buckets = {user_id: bucket for user_id, bucket in self.buckets.items() if bucket[1] > cutoff}
+        self.next_sweep = now + self.idle_time
@@ -2,9 +2,8 @@
 
 
 def check_granted_server(ctx):
-    allowed_channels = map(ctx.bot.get_channel, ctx.bot.config.get("drop_channels", []))
-    return ctx.guild in set([channel.guild for channel in allowed_channels if channel])
+    return ctx.guild is not None and ctx.guild.id in ctx.bot.drop_guild_ids()
 
 
 def in_drop_channel(ctx):
-    return ctx.channel.id in ctx.bot.config.get("drop_channels", [])
+    return ctx.channel.id in ctx.bot.config.drop_channels
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+
+import numbers
+from collections.abc import Mapping
+from types import MappingProxyType
+
+import toml
+
+
+# only read at startup, and never kept in the config itself
+STARTUP_ONLY = ("token", "database")
+
+# settings that are only read at startup, so changing them needs a restart
+RESTART_REQUIRED = frozenset({
+    "shard_count", "clusters", "jishaku", "metrics_host", "metrics_port", "db_health_interval",
+    "ledger_flush_interval", "ledger_batch_size", "event_archive_path", "event_retention_months",
+    "asset_path", "image_engine", "image_workers", "image_max_pending", "image_timeout",
+    "prerender_pool", "prerender_interval", "balance_cache_size", "leaderboard_size", "schedule_interval",
+    "config_watch_interval", "emoji_refresh_interval",
+})
+
+NUMBER = "number"
+POSITIVE = "positive number"  # more than the minimum, not just at least it
+ID_LIST = "id list"
+
+# setting: (kind, smallest allowed value for numbers)
+SETTINGS = {
+    "cooldown_time": (NUMBER, 0),
+    "drops_per_hour": (NUMBER, 0),
+    "active_message_rate": (POSITIVE, 0),
+    "message_rate_half_life": (POSITIVE, 0),
+    "schedule_interval": (NUMBER, 0),
+    "additional_delay": (NUMBER, 0),
+    "pick_timeout": (NUMBER, 0),
+    "cleanup_delay": (NUMBER, 0),
+    "guess_rate": (POSITIVE, 0),
+    "guess_burst": (NUMBER, 1),
+    "prerender_pool": (NUMBER, 1),
+    "prerender_interval": (NUMBER, 0),
+    "image_workers": (NUMBER, 1),
+    "image_max_pending": (NUMBER, 1),
+    "image_timeout": (NUMBER, 0),
+    "ledger_flush_interval": (NUMBER, 0),
+    "ledger_batch_size": (NUMBER, 1),
+    "event_retention_months": (NUMBER, 0),
+    "db_health_interval": (NUMBER, 0),
+    "role_sync_page_size": (NUMBER, 1),
+    "role_sync_interval": (NUMBER, 0),
+    "config_watch_interval": (NUMBER, 1),
+    "emoji_refresh_interval": (NUMBER, 60),
+    "balance_cache_size": (NUMBER, 1),
+    "leaderboard_size": (NUMBER, 1),
+    "drop_channels": (ID_LIST, None),
+    "emoji_sources": (ID_LIST, None),
+    "admin_users": (ID_LIST, None),
+}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def validate(data: dict):
+    """Raises :exc:`ConfigError` describing everything wrong with ``data``."""
+    problems = []
+
+    for key, (kind, minimum) in SETTINGS.items():
+        if key not in data:
+            continue
+
+        value = data[key]
+        if kind in (NUMBER, POSITIVE):
+            if not _is_number(value):
+                problems.append(f"{key} must be a number")
+            elif kind == POSITIVE and value <= minimum:
+                problems.append(f"{key} must be more than {minimum}")
+            elif value < minimum:
+                problems.append(f"{key} must be at least {minimum}")
+        elif not isinstance(value, list) or not all(isinstance(item, int) for item in value):
+            problems.append(f"{key} must be a list of ids")
+
+    if data.get("image_engine", "process") not in ("process", "thread"):
+        problems.append('image_engine must be "process" or "thread"')
+
+    drop_strings = data.get("drop_strings", ["-"])
+    if (not isinstance(drop_strings, list) or not drop_strings
+            or not all(isinstance(item, str) for item in drop_strings)):
+        problems.append("drop_strings must be a list of at least one string")
+
+    for table, check, description in (("reward_roles", lambda value: isinstance(value, int), "role ids"),
+                                      ("emoji_weights", lambda value: _is_number(value) and value >= 0,
+                                       "weights of 0 or more")):
+        entries = data.get(table, {})
+        if not isinstance(entries, dict) or not all(key.isdigit() and check(value) for key, value in entries.items()):
+            problems.append(f"[{table}] must map numbers to {description}")
+
+    if problems:
+        raise ConfigError("; ".join(problems))
+
+
+class Config(Mapping):
+    """A validated, read-only snapshot of the config.
+
+    Reads work like the dict it came from (lists become tuples, tables read-only mappings),
+    plus a few values worked out once per snapshot for the hot paths. Reloading builds a new
+    snapshot rather than changing this one, so anything holding a snapshot sees one
+    consistent config.
+    """
+
+    __slots__ = ("_data", "drop_channels")
+
+    def __init__(self, data: dict = None):
+        data = {key: value for key, value in (data or {}).items() if key not in STARTUP_ONLY}
+        validate(data)
+
+        object.__setattr__(self, "_data", _freeze(data))
+        object.__setattr__(self, "drop_channels", frozenset(data.get("drop_channels", ())))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Config is read-only, reload it instead")
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def changed(self, other: "Config"):
+        """Returns the settings that differ between this snapshot and ``other``."""
+        return sorted(key for key in set(self) | set(other) if self.get(key) != other.get(key))
+
+    @classmethod
+    def from_file(cls, path: str) -> "Config":
+        with open(path, "r", encoding="utf-8") as fp:
+            try:
+                data = toml.load(fp)
+            except toml.TomlDecodeError as error:
+                raise ConfigError(f"{path} isn't valid TOML: {error}") from error
+
+        return cls(data)
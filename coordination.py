@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+import os
+
+import asyncpg
+
+
+NOTIFY_CHANNEL = "coindrop_totals"
+
+# postgres caps NOTIFY payloads at 8000 bytes, so big batches are split up
+MAX_USERS_PER_NOTIFY = 200
+
+CLAIM_DROP = """
+INSERT INTO drop_cooldowns (channel_id, wait_until)
+VALUES ($1, (NOW() AT TIME ZONE 'UTC') + $2 * INTERVAL '1 second')
+ON CONFLICT (channel_id) DO UPDATE
+SET wait_until = EXCLUDED.wait_until
+WHERE drop_cooldowns.wait_until <= (NOW() AT TIME ZONE 'UTC')
+RETURNING channel_id
+"""
+
+
+class Coordinator:
+    """Keeps several shard processes consistent through Postgres.
+
+    Drops claim their channel's cooldown in ``drop_cooldowns`` so only one process can drop
+    in a channel at a time, and balance changes are broadcast with NOTIFY so every process
+    can keep its caches current. Incoming changes are dispatched as ``coin_totals``; if the
+    listening connection drops, ``coin_totals_stale`` is dispatched once it is back, since
+    anything sent in between was missed.
+
+    Every bot listens, even when it runs as a single process, so bulk changes made with
+    ``admin.py`` reach its caches; claims and broadcasts are only used with ``clusters``.
+    """
+
+    def __init__(self, bot, credentials: dict):
+        self.bot = bot
+        self.credentials = credentials
+        self.sender = f"{os.getpid()}:{id(self)}"
+        self.listener_task = None
+
+    def start(self):
+        self.listener_task = self.bot.loop.create_task(self.listen())
+
+    async def listen(self):
+        first = True
+
+        while not self.bot.is_closed():
+            try:
+                conn = await asyncpg.connect(**self.credentials)
+            except (OSError, asyncpg.PostgresError):
+                self.bot.logger.warning("Couldn't open the coordination listener, retrying in 5 seconds.")
+                await asyncio.sleep(5)
+                continue
+
+            try:
+                await conn.add_listener(NOTIFY_CHANNEL, self.on_notify)
+
+                if not first:
+                    self.bot.dispatch("coin_totals_stale")
+                first = False
+
+                while not conn.is_closed():
+                    await asyncio.sleep(5)
+            finally:
+                await conn.close()
+
+            self.bot.logger.warning("Lost the coordination listener, reconnecting.")
+
+    def on_notify(self, connection, pid, channel, payload):
+        message = json.loads(payload)
+
+        if message["sender"] == self.sender:
+            return
+
+        if message.get("stale"):
+            self.bot.dispatch("coin_totals_stale")
+            return
+
+        self.bot.dispatch("coin_totals", {int(user_id): coins for user_id, coins in message["totals"].items()})
+
+    async def publish(self, conn, totals: dict):
+        """Tells the other processes about new balances. ``None`` means the account was removed."""
+        items = list(totals.items())
+
+        try:
+            for index in range(0, len(items), MAX_USERS_PER_NOTIFY):
+                chunk = dict(items[index:index + MAX_USERS_PER_NOTIFY])
+                payload = json.dumps({"sender": self.sender, "totals": chunk})
+                await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, payload)
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            # whatever changed is already written, so don't let callers retry it; other shards just lag behind
+            self.bot.logger.exception(f"Failed to announce {len(items)} balance change(s) to other shards.")
+
+    async def publish_stale(self, conn):
+        """Tells the other processes to drop everything they have cached about balances."""
+        try:
+            await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL,
+                               json.dumps({"sender": self.sender, "stale": True}))
+        except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+            self.bot.logger.exception("Failed to tell other shards their balances are stale.")
+
+    async def claim_drop(self, channel_id: int, cooldown: float) -> bool:
+        async with self.bot.acquire() as conn:
+            return await conn.fetchval(CLAIM_DROP, channel_id, cooldown) is not None
+
+    async def close(self):
+        if self.listener_task is not None:
+            self.listener_task.cancel()
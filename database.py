@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import asyncpg
+
+import ledger
+from cogs import balances, leaderboard
+from coordination import CLAIM_DROP
+
+
+# statements sent on nearly every pick or command, prepared as soon as a connection opens
+PREPARED = (
+    ledger.UPSERT_COINS,
+    balances.FETCH_BALANCE,
+    leaderboard.FETCH_TOP,
+    leaderboard.COUNT_AHEAD,
+    CLAIM_DROP,
+)
+
+# create_pool arguments that a single asyncpg.connect won't take
+POOL_OPTIONS = ("min_size", "max_size", "max_queries", "max_inactive_connection_lifetime")
+
+
+class DropConnection(asyncpg.Connection):
+    """Connection that runs the statements in :data:`PREPARED` through statements prepared up front.
+
+    Callers keep passing the query text as usual; anything else goes through asyncpg's own
+    statement cache.
+    """
+
+    __slots__ = ("prepared",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+    async def _run_prepared(self, method: str, query, args, timeout, kwargs):
+        statement = None if kwargs else self.prepared.get(query)
+
+        if statement is not None:
+            try:
+                return await getattr(statement, method)(*args, timeout=timeout)
+            except asyncpg.InvalidCachedStatementError:
+                # the schema changed under it, let asyncpg handle this one from now on
+                del self.prepared[query]
+
+        return await getattr(super(), method)(query, *args, timeout=timeout, **kwargs)
+
+    async def fetch(self, query, *args, timeout=None, **kwargs):
+        return await self._run_prepared("fetch", query, args, timeout, kwargs)
+
+    async def fetchrow(self, query, *args, timeout=None, **kwargs):
+        return await self._run_prepared("fetchrow", query, args, timeout, kwargs)
+
+    async def fetchval(self, query, *args, timeout=None, **kwargs):
+        return await self._run_prepared("fetchval", query, args, timeout, kwargs)
+
+
+async def prepare_statements(conn: DropConnection):
+    """Pool ``init`` hook."""
+    for query in PREPARED:
+        conn.prepared[query] = await conn.prepare(query)
+
+
+def connect_options(credentials: dict) -> dict:
+    return {key: value for key, value in credentials.items() if key not in POOL_OPTIONS}
+
+
+async def create_pool(credentials: dict) -> asyncpg.pool.Pool:
+    """Creates a pool of :class:`DropConnection`. Returns once ``min_size`` connections are open and prepared."""
+    return await asyncpg.create_pool(connection_class=DropConnection, init=prepare_statements, **credentials)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+import gzip
+import os
+import re
+import shutil
+
+import asyncpg
+
+
+# arbitrary, only one process should archive at a time
+ARCHIVE_LOCK = 0x61726368
+
+PARTITION_NAME = re.compile(r"^coin_events_(\d{4})_(\d{2})$")
+
+LIST_PARTITIONS = """
+SELECT child.relname AS name FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = 'coin_events'
+"""
+
+RESET_USER = """
+WITH removed AS (DELETE FROM currency_users WHERE user_id = $1 RETURNING user_id, coins)
+INSERT INTO coin_events (event_time, user_id, amount, kind)
+SELECT NOW() AT TIME ZONE 'UTC', user_id, -coins, 'reset' FROM removed
+"""
+
+REBUILD_DELETE = """
+DELETE FROM currency_users WHERE user_id NOT IN (
+    SELECT user_id FROM coin_events GROUP BY user_id HAVING SUM(amount) > 0
+)
+"""
+
+REBUILD_UPSERT = """
+INSERT INTO currency_users (user_id, coins, last_picked)
+SELECT user_id, SUM(amount), MAX(event_time) FILTER (WHERE kind IN ('primary', 'bonus'))
+FROM coin_events GROUP BY user_id HAVING SUM(amount) > 0
+ON CONFLICT (user_id) DO UPDATE
+SET coins = EXCLUDED.coins, last_picked = COALESCE(EXCLUDED.last_picked, currency_users.last_picked)
+"""
+
+
+def month_start(when: datetime.datetime, offset: int = 0) -> datetime.datetime:
+    """Returns the start of the month ``offset`` months away from ``when``."""
+    months = when.year * 12 + when.month - 1 + offset
+    return datetime.datetime(months // 12, months % 12 + 1, 1)
+
+
+def partition_name(start: datetime.datetime) -> str:
+    return f"coin_events_{start:%Y_%m}"
+
+
+def compress(path: str):
+    with open(path, "rb") as source, gzip.open(f"{path}.gz", "wb") as target:
+        shutil.copyfileobj(source, target)
+
+    os.remove(path)
+
+
+async def rebuild_balances(conn) -> int:
+    """Recomputes currency_users from coin_events. Returns how many accounts there are afterwards."""
+    async with conn.transaction():
+        # grants wait for this rather than applying themselves to a total that's being replaced
+        await conn.execute("LOCK TABLE currency_users IN EXCLUSIVE MODE")
+        await conn.execute(REBUILD_DELETE)
+        await conn.execute(REBUILD_UPSERT)
+        return await conn.fetchval("SELECT COUNT(*) FROM currency_users")
+
+
+class EventLog:
+    """Looks after the monthly partitions of coin_events.
+
+    Partitions are created a month ahead. Once a partition is older than
+    ``retention_months``, it's copied to a gzipped CSV under ``archive_path``, replaced in
+    the log by one ``carry`` event per user holding their net amount for it, and dropped,
+    so balances can still be rebuilt from what's left.
+    """
+
+    def __init__(self, bot, archive_path: str = "archive", retention_months: int = 6, interval: float = 86400):
+        self.bot = bot
+        self.archive_path = archive_path
+        self.retention_months = retention_months
+        self.interval = interval
+        self.task = None
+
+    def start(self):
+        self.task = self.bot.loop.create_task(self.run())
+
+    async def run(self):
+        while not self.bot.is_closed():
+            try:
+                async with self.bot.acquire() as conn:
+                    await self.ensure_partitions(conn)
+
+                    if self.retention_months > 0:
+                        await self.archive_partitions(conn)
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError):
+                self.bot.logger.exception("Coin event maintenance failed, will try again later.")
+
+            await asyncio.sleep(self.interval)
+
+    async def ensure_partitions(self, conn):
+        now = datetime.datetime.utcnow()
+
+        for offset in (0, 1):
+            start = month_start(now, offset)
+
+            try:
+                await conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {partition_name(start)} PARTITION OF coin_events "
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{month_start(start, 1).isoformat()}')"
+                )
+            except asyncpg.CheckViolationError:
+                # events for this month already landed in the default partition
+                self.bot.logger.warning(f"Couldn't create {partition_name(start)}, its events are in the default "
+                                        f"partition.")
+
+    async def archive_partitions(self, conn):
+        cutoff = month_start(datetime.datetime.utcnow(), -self.retention_months)
+
+        if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", ARCHIVE_LOCK):
+            return
+
+        try:
+            expired = []
+            for record in await conn.fetch(LIST_PARTITIONS):
+                match = PARTITION_NAME.match(record["name"])
+                if match is not None:
+                    start = datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+                    if start < cutoff:
+                        expired.append((start, record["name"]))
+
+            # oldest first, so carries from one month are archived with the next
+            for start, name in sorted(expired):
+                await self.archive_partition(conn, name, month_start(start, 1))
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", ARCHIVE_LOCK)
+
+    async def archive_partition(self, conn, name: str, carry_time: datetime.datetime):
+        os.makedirs(self.archive_path, exist_ok=True)
+        path = os.path.join(self.archive_path, f"{name}.csv")
+
+        await conn.copy_from_table(name, output=path, format="csv", header=True)
+        await self.bot.loop.run_in_executor(None, compress, path)
+
+        async with conn.transaction():
+            await conn.execute(
+                f"INSERT INTO coin_events (event_time, user_id, amount, kind) "
+                f"SELECT $1, user_id, SUM(amount), 'carry' FROM {name} GROUP BY user_id HAVING SUM(amount) <> 0",
+                carry_time
+            )
+            await conn.execute(f"ALTER TABLE coin_events DETACH PARTITION {name}")
+            await conn.execute(f"DROP TABLE {name}")
+
+        self.bot.logger.info(f"Archived {name} to {path}.gz")
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+
+
+# appends the batch to coin_events and applies what was logged to currency_users, in one round trip
+UPSERT_COINS = """
+WITH events AS (
+    INSERT INTO coin_events (event_time, user_id, amount, kind, coin_id, channel_id, latency)
+    SELECT * FROM unnest($1::TIMESTAMP[], $2::BIGINT[], $3::INT[], $4::TEXT[], $5::TEXT[], $6::BIGINT[],
+                         $7::REAL[])
+    RETURNING event_time, user_id, amount
+)
+INSERT INTO currency_users (user_id, coins, last_picked)
+SELECT user_id, SUM(amount), MAX(event_time) FROM events GROUP BY user_id
+ON CONFLICT (user_id) DO UPDATE
+SET coins = currency_users.coins + EXCLUDED.coins, last_picked = EXCLUDED.last_picked
+RETURNING user_id, coins
+"""
+
+
+class CoinLedger:
+    """Write-behind buffer for coin grants.
+
+    Grants are collected in memory and written as a single statement every ``interval``
+    seconds, or as soon as ``max_batch`` grants are waiting. The statement logs every grant
+    to coin_events and applies them to currency_users. Each grant resolves to the user's
+    balance as of that grant once its batch is written, and every written batch is
+    announced through the ``coin_totals`` event.
+    """
+
+    def __init__(self, bot, interval: float = 0.25, max_batch: int = 50):
+        self.bot = bot
+        self.interval = interval
+        self.max_batch = max_batch
+        self.pending = []  # (future, (event_time, user_id, amount, kind, coin_id, channel_id, latency))
+        self.flush_handle = None
+        self.flush_lock = asyncio.Lock()
+
+    @property
+    def pending_count(self):
+        return len(self.pending)
+
+    def grant(self, user_id: int, when, amount: int = 1, *, kind: str = "primary", coin_id: str = None,
+              channel_id: int = None, latency: float = None) -> asyncio.Future:
+        future = self.bot.loop.create_future()
+        self.pending.append((future, (when, user_id, amount, kind, coin_id, channel_id, latency)))
+
+        if len(self.pending) >= self.max_batch:
+            self.schedule_flush(0)
+        elif self.flush_handle is None:
+            self.schedule_flush(self.interval)
+
+        return future
+
+    def schedule_flush(self, delay: float):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+
+        self.flush_handle = self.bot.loop.call_later(delay, lambda: self.bot.loop.create_task(self.flush()))
+
+    async def flush(self):
+        async with self.flush_lock:
+            self.flush_handle = None
+            batch, self.pending = self.pending, []
+
+            if not batch:
+                return
+
+            await self.bot.db_available.wait()
+
+            columns = [list(column) for column in zip(*(event for _, event in batch))]
+            try:
+                async with self.bot.acquire() as conn:
+                    with self.bot.db_time.time(operation="upsert_coins"):
+                        records = await conn.fetch(UPSERT_COINS, *columns)
+
+                    totals = {record["user_id"]: record["coins"] for record in records}
+
+                    if self.bot.coordinator is not None:
+                        await self.bot.coordinator.publish(conn, totals)
+            except Exception:
+                self.bot.logger.exception(f"Failed to write {len(batch)} coin grant(s), retrying.")
+                self.requeue(batch)
+                return
+
+        self.bot.dispatch("coin_totals", totals)
+
+        # hand every grant the balance it produced, newest first
+        running = dict(totals)
+        for future, (_, user_id, amount, *_) in reversed(batch):
+            if not future.done():
+                future.set_result(running[user_id])
+            running[user_id] -= amount
+
+    def requeue(self, batch):
+        self.pending[:0] = batch
+        self.schedule_flush(max(self.interval, 1))
+
+    async def close(self):
+        """Writes out everything still pending. Called on shutdown."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        await self.flush()
+
+        if self.pending:
+            if self.flush_handle is not None:
+                self.flush_handle.cancel()
+
+            unwritten = {}
+            for _, (_, user_id, amount, *_) in self.pending:
+                unwritten[user_id] = unwritten.get(user_id, 0) + amount
+            self.bot.logger.critical(f"Shutting down with {len(self.pending)} unwritten coin grant(s): {unwritten}")
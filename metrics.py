@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 90)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[label] for label in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labels, key), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values: [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[label] for label in self.labels)
+
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [0] * (len(self.buckets) + 2)
+
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[index] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, entry in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                yield f"{self.name}_bucket", _format_labels(self.labels, key, [("le", bound)]), cumulative
+            yield f"{self.name}_bucket", _format_labels(self.labels, key, [("le", "+Inf")]), entry[-1]
+            yield f"{self.name}_sum", _format_labels(self.labels, key), entry[-2]
+            yield f"{self.name}_count", _format_labels(self.labels, key), entry[-1]
+
+
+class Gauge:
+    """A value read at scrape time from ``function``, which returns a number or a dict of label value: number."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, function, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.function()
+
+        if not isinstance(value, dict):
+            yield self.name, "", value
+            return
+
+        for key, item in value.items():
+            yield self.name, _format_labels(self.labels, key if isinstance(key, tuple) else (key,)), item
+
+
+class Registry:
+    """Collects metrics and renders them in the Prometheus text format.
+
+    Metrics are looked up by name, so reloading an extension picks its metrics back up.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self._register(Counter, name, documentation, labels)
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labels, buckets)
+
+    def gauge(self, name: str, documentation: str, function, labels=()) -> Gauge:
+        # gauges close over whatever registered them, so always take the newest function
+        metric = self.metrics[name] = Gauge(name, documentation, function, labels)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+
+        return "\n".join(lines) + "\n"
+
+
+async def start_server(registry: Registry, host: str, port: int) -> web.AppRunner:
+    async def handle(request):
+        return web.Response(body=registry.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError:
+        await runner.cleanup()
+        raise
+
+    return runner
@@ -0,0 +1,3 @@
+-- Lets the leaderboard and rank queries walk an index instead of sorting the table.
+
+CREATE INDEX IF NOT EXISTS currency_users_coins_idx ON currency_users (coins DESC, user_id);
@@ -0,0 +1,6 @@
+-- Lets shard processes agree on when each drop channel may drop next.
+
+CREATE TABLE IF NOT EXISTS drop_cooldowns (
+    channel_id BIGINT PRIMARY KEY,
+    wait_until TIMESTAMP NOT NULL
+);
@@ -0,0 +1,32 @@
+-- Append-only log of every coin grant and reset. currency_users is the running total of it,
+-- and can be rebuilt from it with the rebuild_balances command.
+
+CREATE TABLE IF NOT EXISTS coin_events (
+    event_time TIMESTAMP NOT NULL,
+    user_id BIGINT NOT NULL,
+    amount INT NOT NULL,
+    kind TEXT NOT NULL,
+    coin_id TEXT,
+    channel_id BIGINT,
+    latency REAL
+) PARTITION BY RANGE (event_time);
+
+CREATE TABLE IF NOT EXISTS coin_events_default PARTITION OF coin_events DEFAULT;
+
+CREATE INDEX IF NOT EXISTS coin_events_user_idx ON coin_events (user_id, event_time);
+
+-- monthly partitions after this one are made ahead of time by the bot
+DO $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', NOW() AT TIME ZONE 'UTC');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF coin_events FOR VALUES FROM (%L) TO (%L)',
+        'coin_events_' || to_char(month_start, 'YYYY_MM'), month_start, month_start + INTERVAL '1 month'
+    );
+END
+$$;
+
+-- balances from before the log existed
+INSERT INTO coin_events (event_time, user_id, amount, kind)
+SELECT NOW() AT TIME ZONE 'UTC', user_id, coins, 'seed' FROM currency_users WHERE coins > 0;
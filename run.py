@@ -1,43 +1,83 @@
 # -*- coding: utf-8 -*-
+import argparse
 import asyncio
 
 import logging
+import subprocess
 import sys
 
 import toml
+from discord.ext import commands
 
-from bot import DropBot
+from bot import DropBot, ShardedDropBot
 
-try:
-    import uvloop
-except ImportError:
-    pass
-else:
-    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
+def main():
+    try:
+        import uvloop
+    except ImportError:
+        pass
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-logging.getLogger('discord').setLevel(logging.INFO)
-logging.getLogger('dropbot').setLevel(logging.DEBUG)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cluster", type=int, default=None, help="index into `clusters` to run in this process")
+    args = parser.parse_args()
 
-formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+    with open('config.toml', 'r', encoding='utf-8') as fp:
+        config = toml.load(fp)
 
-handler = logging.FileHandler(filename='dropbot.log', encoding='utf-8', mode='a')
-handler.setFormatter(formatter)
+    clusters = config.get("clusters")
 
-stream = logging.StreamHandler(stream=sys.stdout)
-stream.setFormatter(formatter)
+    if clusters and args.cluster is None:
+        # launcher: run every cluster in its own process and wait on them
+        processes = [subprocess.Popen([sys.executable, __file__, "--cluster", str(index)])
+                     for index in range(len(clusters))]
 
-logging.getLogger().addHandler(handler)
-logging.getLogger().addHandler(stream)
+        try:
+            for process in processes:
+                process.wait()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
 
-with open('config.toml', 'r', encoding='utf-8') as fp:
-    config = toml.load(fp)
+        sys.exit(max(process.wait() for process in processes))
 
-token = config.pop("token")
+    logging.getLogger('discord').setLevel(logging.INFO)
+    logging.getLogger('dropbot').setLevel(logging.DEBUG)
 
+    formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s')
 
-bot = DropBot('.', config=config)
+    log_name = 'dropbot.log' if args.cluster is None else f'dropbot-{args.cluster}.log'
+    handler = logging.FileHandler(filename=log_name, encoding='utf-8', mode='a')
+    handler.setFormatter(formatter)
 
-bot.load_extension("jishaku")
-bot.load_extension("cogs.coindrop")
-bot.run(token)
+    stream = logging.StreamHandler(stream=sys.stdout)
+    stream.setFormatter(formatter)
+
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().addHandler(stream)
+
+    token = config.pop("token")
+
+    if clusters:
+        bot = ShardedDropBot('.', config=config, config_path='config.toml', shard_ids=clusters[args.cluster],
+                             shard_count=config["shard_count"], cluster=args.cluster)
+    elif "shard_count" in config:
+        bot = ShardedDropBot('.', config=config, config_path='config.toml', shard_count=config["shard_count"])
+    else:
+        bot = DropBot('.', config=config, config_path='config.toml')
+
+    if config.get("jishaku", True):
+        try:
+            bot.load_extension("jishaku")
+        except commands.ExtensionNotFound:
+            bot.logger.warning("jishaku is enabled but not installed, skipping it.")
+
+    bot.load_extension("cogs.coindrop")
+    bot.run(token)
+
+
+# image workers are spawned processes that import this module again, so they mustn't start a bot of their own
+if __name__ == "__main__":
+    main()
@@ -7,3 +7,29 @@ CREATE TABLE IF NOT EXISTS currency_users (
 
     CONSTRAINT no_debt_please CHECK (coins >= 0)
 );
+
+CREATE INDEX IF NOT EXISTS currency_users_coins_idx ON currency_users (coins DESC, user_id);
+
+CREATE TABLE IF NOT EXISTS drop_cooldowns (
+    channel_id BIGINT PRIMARY KEY,
+    wait_until TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS coin_events (
+    event_time TIMESTAMP NOT NULL,
+    user_id BIGINT NOT NULL,
+    amount INT NOT NULL,
+    kind TEXT NOT NULL,
+    coin_id TEXT,
+    channel_id BIGINT,
+    latency REAL
+) PARTITION BY RANGE (event_time);
+
+CREATE TABLE IF NOT EXISTS coin_events_default PARTITION OF coin_events DEFAULT;
+
+CREATE INDEX IF NOT EXISTS coin_events_user_idx ON coin_events (user_id, event_time);
+
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    name TEXT PRIMARY KEY,
+    applied_at TIMESTAMP DEFAULT (NOW() AT TIME ZONE 'UTC')
+);
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+
+import pytest
+
+from admin import Selection, read_jsonl
+
+
+def test_selection_builds_numbered_conditions():
+    selection = Selection.parse(["<@!122122926760656896>", "69198249432449024", "coins>=100", "last_picked<2020-01-01"])
+
+    assert str(selection) == "2 listed user(s), coins>=100, last_picked<2020-01-01 00:00:00"
+    assert selection.where(2) == (
+        "user_id = ANY($2::BIGINT[]) AND coins >= $3 AND last_picked < $4",
+        [[122122926760656896, 69198249432449024], 100, datetime.datetime(2020, 1, 1)],
+    )
+
+    assert not Selection.parse([])
+    assert Selection.parse([]).where() == ("TRUE", [])
+
+    for term in ("coins>=lots", "coins; DROP TABLE currency_users", "balance>5"):
+        with pytest.raises(ValueError):
+            Selection.parse([term])
+
+
+def test_read_jsonl_chunks_and_reports_bad_lines():
+    fp = io.StringIO('{"user_id": 1, "coins": 5, "last_picked": "2020-01-01T12:00:00"}\n\n'
+                     '{"user_id": 2, "coins": 3, "last_picked": null}\n'
+                     '{"user_id": 3, "coins": 1}\n')
+
+    assert list(read_jsonl(fp, 2)) == [
+        [(1, 5, datetime.datetime(2020, 1, 1, 12)), (2, 3, None)],
+        [(3, 1, None)],
+    ]
+
+    with pytest.raises(ValueError, match="Line 2"):
+        list(read_jsonl(io.StringIO('{"user_id": 1, "coins": 5}\n{"user_id": 2}\n'), 10))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cogs.assets import AssetStore
+
+
+def test_concurrent_writes_keep_the_index_whole(tmp_path):
+    store = AssetStore(str(tmp_path))
+
+    def work(emoji_id):
+        data = f"emoji {emoji_id}".encode()
+        store.put_raw(emoji_id, data)
+        store.put_filtered(emoji_id, 0, data + b" filtered")
+        if emoji_id % 3 == 0:
+            store.forget([emoji_id])
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        # list() so an exception in any worker fails the test
+        list(executor.map(work, range(200)))
+
+    kept = {emoji_id for emoji_id in range(200) if emoji_id % 3}
+    assert set(store.emoji_ids()) == kept
+
+    with open(store.index_path, "r", encoding="utf-8") as fp:
+        assert {int(key) for key in json.load(fp)} == kept
+
+    assert not [name for name in os.listdir(tmp_path) + os.listdir(store.objects) if name.endswith(".tmp")]
+
+    store.prune()
+    assert store.raw(1) == b"emoji 1"
+    assert store.filtered(1, 0) == b"emoji 1 filtered"
+    assert store.raw(3) is None
+    assert len(os.listdir(store.objects)) == len(kept) * 2
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from configuration import Config, ConfigError
+
+
+def test_config_is_a_frozen_snapshot():
+    config = Config({"token": "secret", "drop_channels": [1, 2], "reward_roles": {"10": 5}, "cooldown_time": 20})
+
+    assert "token" not in config
+    assert config.drop_channels == {1, 2}
+    assert config["drop_channels"] == (1, 2)
+
+    with pytest.raises(TypeError):
+        config["reward_roles"]["20"] = 6
+    with pytest.raises(AttributeError):
+        config.drop_channels = frozenset()
+
+    assert config.changed(Config({"drop_channels": [1, 2], "cooldown_time": 30})) == ["cooldown_time", "reward_roles"]
+
+
+def test_config_validation_reports_every_problem():
+    with pytest.raises(ConfigError) as error:
+        Config({"cooldown_time": -1, "guess_burst": "3", "drop_channels": ["general"], "emoji_weights": {"1": -2}})
+
+    message = str(error.value)
+    for problem in ("cooldown_time must be at least 0", "guess_burst must be a number",
+                    "drop_channels must be a list of ids", "[emoji_weights]"):
+        assert problem in message
+
+
+def test_rates_that_are_divided_by_must_be_positive():
+    for key in ("guess_rate", "active_message_rate", "message_rate_half_life"):
+        with pytest.raises(ConfigError, match=f"{key} must be more than 0"):
+            Config({key: 0})
+
+        assert Config({key: 0.5})[key] == 0.5
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+import tempfile
+import time
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import metrics
+from cogs import coindrop, drops
+from configuration import Config
+
+DROP_CHANNEL = 357651359379750917
+EMOJI_GUILD = 272885620769161216
+
+
+class FakeEmoji(SimpleNamespace):
+    def __str__(self):
+        return f"<:{self.name}:{self.id}>"
+
+
+class Timer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    """Runs tasks on a real loop, but only fires timers when the test moves the clock on."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.now = 0.0
+        self.timers = []
+
+    def __getattr__(self, name):
+        return getattr(self.loop, name)
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.now + delay, callback, args)
+        self.timers.append(timer)
+        return timer
+
+    def advance(self, seconds):
+        self.now += seconds
+
+        for timer in sorted(self.timers, key=lambda timer: timer.when):
+            if timer.when <= self.now:
+                self.timers.remove(timer)
+                if not timer.cancelled:
+                    timer.callback(*timer.args)
+
+        self.settle()
+
+    def settle(self):
+        # let the grants and the outbox run
+        self.loop.run_until_complete(asyncio.sleep(0.01))
+
+
+class FakeMessage:
+    def __init__(self, content, channel):
+        self.content = content
+        self.channel = channel
+        self.edits = 0
+
+    async def edit(self, content):
+        self.content = content
+        self.edits += 1
+
+
+class FakeChannel:
+    id = DROP_CHANNEL
+
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+
+    async def send(self, content, file=None):
+        message = FakeMessage(content, self)
+        self.sent.append(message)
+        return message
+
+    async def delete_messages(self, messages):
+        self.deleted.extend(messages)
+
+
+class FakeLedger:
+    def __init__(self, loop):
+        self.loop = loop
+        self.balances = {}
+        self.grants = []
+
+    def grant(self, user_id, when, amount=1, *, kind="primary", **event):
+        self.grants.append((user_id, kind))
+        self.balances[user_id] = self.balances.get(user_id, 0) + amount
+
+        future = self.loop.create_future()
+        future.set_result(self.balances[user_id])
+        return future
+
+
+@pytest.fixture
+def drop(monkeypatch):
+    loop = FakeLoop(asyncio.new_event_loop())
+    monkeypatch.setattr(coindrop, "time", SimpleNamespace(monotonic=lambda: loop.now, perf_counter=time.perf_counter))
+
+    bot = SimpleNamespace(
+        config=Config({
+            "drop_channels": [DROP_CHANNEL],
+            "emoji_sources": [EMOJI_GUILD],
+            "drop_strings": ["What blob is this?"],
+            "currency": {"singular": "coin", "plural": "coins"},
+            "additional_delay": 10,
+            "pick_timeout": 90,
+            "cleanup_delay": 0,
+            "image_engine": "thread",
+            "asset_path": tempfile.mkdtemp(),
+        }),
+        loop=loop,
+        logger=logging.getLogger("dropbot"),
+        metrics=metrics.Registry(),
+        add_startup_step=lambda name: None,
+        get_guild=lambda guild_id: None,
+        started=asyncio.Event(),
+        wait_until_ready=loop.create_future,
+        is_closed=lambda: True,
+        coordinator=None,
+        user=SimpleNamespace(id=1),
+    )
+    bot.ledger = FakeLedger(loop)
+    cog = coindrop.CoinDrop(bot)
+
+    emoji = FakeEmoji(name="blobthinkingeyes", id=396144014128054275, url="", animated=False)
+    cog.catalog.set_guild(EMOJI_GUILD, [emoji])
+    cog.renders.put(emoji.id, 0, b"png")
+
+    channel = FakeChannel()
+    state = cog.channels[DROP_CHANNEL]
+    loop.run_until_complete(cog.perform_natural_drop(state, channel, "0" * 16))
+
+    def guess(user_id, content="blobthinkingeyes"):
+        message = SimpleNamespace(content=content, channel=channel, created_at=datetime.datetime.utcnow(),
+                                  author=SimpleNamespace(id=user_id, mention=f"<@{user_id}>"))
+        loop.run_until_complete(cog.on_message(message))
+        loop.settle()
+
+    yield SimpleNamespace(cog=cog, loop=loop, state=state, channel=channel, message=channel.sent[0],
+                          ledger=bot.ledger, guess=guess)
+
+    cog.cog_unload()
+    loop.settle()
+    loop.loop.close()
+
+
+def test_pick_in_bonus_window_is_announced_when_it_closes(drop):
+    assert drop.state.phase == drops.LIVE
+
+    drop.loop.advance(2)
+    drop.guess(100)
+
+    assert drop.state.phase == drops.PICKED
+    assert drop.ledger.grants == [(100, "primary"), (100, "bonus")]
+    assert drop.ledger.balances[100] == 2
+    # held back until the bonus window closes
+    assert drop.message.edits == 0
+
+    drop.loop.advance(8)
+    assert drop.message.edits == 1
+    assert "<@100> That's the one! Have 2 coins!" in drop.message.content
+    assert "The correct blob was" in drop.message.content
+
+    drop.loop.advance(1)
+    assert drop.state.phase == drops.IDLE
+    assert drop.state.drop is None
+    assert drop.message not in drop.channel.deleted  # the answer stays up
+
+
+def test_second_correct_guess_is_only_a_bonus(drop):
+    drop.loop.advance(1)
+    drop.guess(100)
+    drop.guess(200)
+
+    assert drop.ledger.grants == [(100, "primary"), (100, "bonus"), (200, "bonus")]
+    assert drop.state.drop.winner == 100
+    assert drop.cog.drop_events.values[("pick",)] == 1
+
+    drop.loop.advance(9)
+    assert "1 user(s) were fast enough" in drop.message.content
+    assert "<@200>" not in drop.message.content
+
+
+def test_pick_after_bonus_window_is_announced_straight_away(drop):
+    drop.loop.advance(15)
+    assert drop.message.edits == 1  # the answer went out when the window closed
+
+    drop.guess(100)
+
+    assert drop.ledger.grants == [(100, "primary")]
+    assert drop.message.edits == 2
+    assert drop.message.content.endswith("<@100> That's the one! Have a coin!")
+
+    drop.loop.advance(1)
+    assert drop.state.phase == drops.IDLE
+
+
+def test_unpicked_drop_is_deleted_when_it_times_out(drop):
+    drop.loop.advance(89)
+    assert drop.state.phase == drops.LIVE
+
+    drop.loop.advance(1)
+
+    assert drop.state.phase == drops.IDLE
+    assert drop.state.drop is None
+    assert drop.channel.deleted == [drop.message]
+    assert drop.ledger.grants == []
+    assert drop.cog.drop_events.values[("timeout",)] == 1
+
+
+def test_chatting_during_a_drop_does_not_use_up_guesses(drop):
+    for content in ("lol", "what is that", "no idea", "hm", "this is a much longer message than any answer " * 2):
+        drop.guess(100, content)
+
+    drop.guess(100)
+
+    assert drop.state.drop.winner == 100
+    assert drop.cog.throttled_guesses.values == {}
+
+
+def test_source_guilds_held_by_another_cluster_are_loaded_over_http(drop):
+    emojis = [FakeEmoji(name="blobwave", id=1, url="", animated=False),
+              FakeEmoji(name="blobsad", id=2, url="", animated=False)]
+    fetched = []
+
+    async def fetch_guild(guild_id):
+        fetched.append(guild_id)
+        return SimpleNamespace(id=guild_id, emojis=emojis)
+
+    # this process doesn't hold the source guild, so it never sees it in its cache
+    drop.cog.bot.fetch_guild = fetch_guild
+    for emoji in emojis:
+        drop.cog.assets.put_raw(emoji.id, b"png")
+
+    drop.loop.run_until_complete(drop.cog.load_remote_sources())
+    assert fetched == [EMOJI_GUILD]
+    assert {entry.id for entry in drop.cog.catalog} == {1, 2}
+
+    # an emoji removed on the other cluster's shard is dropped at the next refresh
+    emojis.pop()
+    drop.loop.run_until_complete(drop.cog.load_remote_sources())
+    assert {entry.id for entry in drop.cog.catalog} == {1}
+    assert 2 not in drop.cog.assets
+
+    async def removed(guild_id):
+        raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), "Missing Access")
+
+    drop.cog.bot.fetch_guild = removed
+    drop.loop.run_until_complete(drop.cog.load_remote_sources())
+    assert len(drop.cog.catalog) == 0
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import random
+
+from cogs.leaderboard import Leaderboard
+
+
+def expected_top(balances, limit):
+    ordered = sorted(balances.items(), key=lambda item: (-item[1], item[0]))
+    return ordered[:limit]
+
+
+def test_leaderboard_tracks_table():
+    rng = random.Random(1234)
+    balances = {user_id: rng.randrange(0, 40) for user_id in range(200)}
+
+    board = Leaderboard(capacity=20)
+    board.begin_load()
+    board.load([{"user_id": user_id, "coins": coins} for user_id, coins in expected_top(balances, 20)])
+
+    for _ in range(2000):
+        user_id = rng.randrange(260)
+        roll = rng.random()
+
+        if roll < 0.05 and user_id in balances:
+            del balances[user_id]
+            board.remove(user_id)
+        elif roll < 0.1 and user_id in balances:
+            balances[user_id] = max(balances[user_id] - rng.randrange(1, 10), 0)
+            board.update(user_id, balances[user_id])
+        else:
+            balances[user_id] = balances.get(user_id, 0) + rng.randrange(1, 3)
+            board.update(user_id, balances[user_id])
+
+        if board.needs_load(8):
+            board.begin_load()
+            board.load([{"user_id": user_id, "coins": coins} for user_id, coins in expected_top(balances, 20)])
+
+        assert board.top(8) == expected_top(balances, 8)
+
+
+def test_leaderboard_replays_changes_made_during_load():
+    board = Leaderboard(capacity=3)
+    board.begin_load()
+    board.update(4, 50)
+    board.remove(1)
+    board.load([{"user_id": 1, "coins": 30}, {"user_id": 2, "coins": 20}, {"user_id": 3, "coins": 10}])
+
+    assert board.top(3) == [(4, 50), (2, 20)]
+    assert board.rank(2) == 2
+    assert board.rank(3) is None
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import logging
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import metrics
+from ledger import CoinLedger
+
+NOW = datetime.datetime(2020, 1, 1)
+
+
+class FakeDatabase:
+    """Applies UPSERT_COINS to a dict of balances, failing the next ``failures`` writes."""
+
+    def __init__(self, balances=None):
+        self.balances = dict(balances or {})
+        self.failures = 0
+        self.writes = 0
+
+    async def fetch(self, query, event_times, user_ids, amounts, *columns):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionResetError("connection lost")
+
+        self.writes += 1
+        changed = {}
+        for user_id, amount in zip(user_ids, amounts):
+            changed[user_id] = self.balances[user_id] = self.balances.get(user_id, 0) + amount
+
+        return [{"user_id": user_id, "coins": coins} for user_id, coins in changed.items()]
+
+
+def make_ledger(db, loop, **kwargs):
+    @asynccontextmanager
+    async def acquire():
+        yield db
+
+    db_available = asyncio.Event()
+    db_available.set()
+
+    bot = SimpleNamespace(
+        loop=loop,
+        logger=logging.getLogger("dropbot"),
+        db_available=db_available,
+        acquire=acquire,
+        db_time=metrics.Registry().histogram("db_seconds", "", labels=("operation",)),
+        coordinator=None,
+        dispatched=[],
+    )
+    bot.dispatch = lambda event, *args: bot.dispatched.append((event, *args))
+
+    return CoinLedger(bot, **kwargs), bot
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro(loop))
+    finally:
+        loop.close()
+
+
+def test_grants_resolve_to_their_own_running_balance():
+    db = FakeDatabase({1: 10})
+
+    async def scenario(loop):
+        ledger, bot = make_ledger(db, loop, interval=60)
+        grants = [ledger.grant(1, NOW), ledger.grant(1, NOW, 2, kind="bonus"), ledger.grant(2, NOW),
+                  ledger.grant(1, NOW)]
+
+        await ledger.flush()
+        return [grant.result() for grant in grants], bot.dispatched
+
+    balances, dispatched = run(scenario)
+
+    # every grant sees the balance it produced, so thresholds crossed mid-batch aren't missed
+    assert balances == [11, 13, 1, 14]
+    assert dispatched == [("coin_totals", {1: 14, 2: 1})]
+    assert db.writes == 1
+
+
+def test_failed_flush_requeues_the_batch():
+    db = FakeDatabase()
+    db.failures = 1
+
+    async def scenario(loop):
+        ledger, _ = make_ledger(db, loop, interval=60)
+        first = ledger.grant(1, NOW)
+
+        await ledger.flush()
+        assert not first.done()
+        assert ledger.pending_count == 1
+        assert ledger.flush_handle is not None  # retry is scheduled
+
+        second = ledger.grant(1, NOW)
+        await ledger.flush()
+
+        # the failed grant stays ahead of the one added after it
+        return first.result(), second.result()
+
+    assert run(scenario) == (1, 2)
+    assert db.balances == {1: 2}
+
+
+def test_close_writes_out_everything_pending():
+    db = FakeDatabase()
+
+    async def scenario(loop):
+        ledger, _ = make_ledger(db, loop, interval=60)
+        grants = [ledger.grant(user_id, NOW) for user_id in (1, 2, 2)]
+
+        await ledger.close()
+        assert ledger.pending_count == 0
+        return [grant.result() for grant in grants]
+
+    assert run(scenario) == [1, 1, 2]
+    assert db.balances == {1: 1, 2: 2}
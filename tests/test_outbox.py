@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import discord
+
+from cogs.outbox import ChannelOutbox
+
+BOT_ID = 1
+
+
+class NoManageMessagesChannel:
+    id = 10
+
+    def __init__(self):
+        self.deleted = []
+
+    async def delete_messages(self, messages):
+        raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions")
+
+    def message(self, author_id):
+        message = SimpleNamespace(author=SimpleNamespace(id=author_id))
+
+        async def delete():
+            if author_id != BOT_ID:
+                raise discord.Forbidden(SimpleNamespace(status=403, reason="Forbidden"), "Missing Permissions")
+            self.deleted.append(message)
+
+        message.delete = delete
+        return message
+
+
+def test_own_messages_are_deleted_without_manage_messages():
+    loop = asyncio.new_event_loop()
+    bot = SimpleNamespace(loop=loop, logger=logging.getLogger("dropbot"), user=SimpleNamespace(id=BOT_ID))
+    channel = NoManageMessagesChannel()
+    outbox = ChannelOutbox(bot, channel, delay=0)
+
+    drop_message, guess = channel.message(BOT_ID), channel.message(2)
+    outbox.delete(drop_message)
+    outbox.delete(guess)
+
+    loop.run_until_complete(outbox.flush_task)
+    loop.close()
+
+    assert channel.deleted == [drop_message]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from cogs.rewards import RewardThresholds, RoleGrants
+
+
+def test_thresholds_catch_skipped_rewards():
+    rewards = RewardThresholds({"100": 1, "10": 2, "50": 3})
+
+    assert rewards.crossed(9, 10) == [(10, 2)]
+    assert rewards.crossed(10, 11) == []
+    # a batch that jumps past several thresholds gets all of them
+    assert rewards.crossed(9, 120) == [(10, 2), (50, 3), (100, 1)]
+    assert rewards.earned(60) == [(10, 2), (50, 3)]
+    assert rewards.lowest == 10
+
+
+def test_role_grants_made_during_a_flush_go_out():
+    loop = asyncio.new_event_loop()
+    bot = SimpleNamespace(loop=loop, logger=logging.getLogger("dropbot"))
+    grants = RoleGrants(bot, delay=0)
+    guild = SimpleNamespace(id=1, get_role=lambda role_id: SimpleNamespace(id=role_id))
+
+    def member(member_id):
+        async def add_roles(*roles, reason):
+            added.setdefault(member_id, []).extend(role.id for role in roles)
+            if member_id == 1:
+                # lands while the first member's roles are still being added
+                grants.add(second, [(50, 6)])
+            await asyncio.sleep(0)
+
+        return SimpleNamespace(id=member_id, guild=guild, roles=[], add_roles=add_roles)
+
+    added = {}
+    first, second = member(1), member(2)
+
+    async def run():
+        grants.add(first, [(10, 5)])
+        while not grants.flush_task.done():
+            await grants.flush_task
+
+    loop.run_until_complete(run())
+    loop.close()
+
+    assert added == {1: [5], 2: [6]}
+    assert not grants.pending
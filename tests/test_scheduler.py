@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+import random
+
+from cogs.scheduler import DropScheduler, simulate
+
+
+def test_drop_rate_follows_activity():
+    def traffic(per_minute, hours, seed):
+        rng = random.Random(seed)
+        now, timestamps = 0.0, []
+        while now < hours * 3600:
+            now += rng.expovariate(per_minute / 60)
+            timestamps.append(now)
+        return timestamps
+
+    def drops_per_hour(per_minute):
+        scheduler = DropScheduler(drops_per_hour=30, active_rate=10, rng=random.Random(1))
+        return len(simulate(scheduler, traffic(per_minute, 20, 2), cooldown=0)) / 20
+
+    # busy channels are capped at the target, quiet ones get proportionally fewer
+    assert 25 < drops_per_hour(60) < 35
+    assert 25 < drops_per_hour(12) < 35
+    assert 4 < drops_per_hour(2) < 8
+    assert drops_per_hour(0.1) < 1
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from cogs.throttle import GuessLimiter
+
+
+def test_guess_limiter_refills_and_expires():
+    limiter = GuessLimiter(rate=2, burst=3)
+
+    assert [limiter.allow(1, 0.0) for _ in range(4)] == [True, True, True, False]
+    assert limiter.allow(2, 0.0)
+
+    assert not limiter.allow(1, 0.4)
+    assert limiter.allow(1, 0.5)
+    assert not limiter.allow(1, 0.5)
+
+    # both buckets would be full again by now, so they're swept out
+    assert limiter.allow(3, 10.0)
+    assert len(limiter) == 1